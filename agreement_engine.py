@@ -0,0 +1,350 @@
+import numpy as np
+import pandas as pd
+
+"""
+A NumPy agreement engine for inter-rater reliability.
+
+All of the ratings are held in one integer array of shape (raters, items, metrics), where each value is an
+answer category in [0, n_categories). Every statistic is computed for all metrics at once, with array
+operations rather than Python loops over items, so the engine scales to tens of thousands of items.
+
+The statistics (all nominal, i.e. unweighted):
+- observed agreement: the mean, over items, of the proportion of agreeing rater pairs
+- Fleiss' kappa
+- Cohen's kappa, for every pair of raters
+- Krippendorff's alpha
+"""
+
+"""
+function: encode_ratings
+
+Converts an array of raw answers (raters x items x metrics) to integer categories, using one conversion
+dict per metric.
+"""
+def encode_ratings(answers, conversion_dicts):
+	answers = np.asarray(answers, dtype=object)
+	ratings = np.empty(answers.shape, dtype=np.int64)
+	for metric_index, conversion_dict in enumerate(conversion_dicts):
+		labels, inverse = np.unique(answers[..., metric_index].astype(str), return_inverse=True)
+		codes = np.array([conversion_dict[label] for label in labels], dtype=np.int64)
+		ratings[..., metric_index] = codes[inverse].reshape(answers.shape[:2])
+	return ratings
+
+"""
+function: category_counts
+
+Returns an (items x metrics x categories) array with the number of raters choosing each category.
+"""
+def category_counts(ratings, n_categories):
+	return np.eye(n_categories, dtype=np.int64)[ratings].sum(axis=0)
+
+def _item_agreement(counts):
+	n = counts.sum(axis=-1)
+	with np.errstate(divide="ignore", invalid="ignore"):
+		return (counts * (counts - 1)).sum(axis=-1) / (n * (n - 1)), n
+
+"""
+function: observed_agreement
+
+Per metric: the mean proportion of agreeing rater pairs over all items rated by at least two raters.
+"""
+def observed_agreement(counts):
+	item_agreement, n = _item_agreement(counts)
+	rated = n > 1
+	return np.where(rated, item_agreement, 0).sum(axis=0) / rated.sum(axis=0)
+
+"""
+function: fleiss_kappa
+
+Per metric: Fleiss' kappa.
+"""
+def fleiss_kappa(counts):
+	p_observed = observed_agreement(counts)
+	proportions = counts.sum(axis=0) / counts.sum(axis=(0, 2))[:, np.newaxis]
+	p_expected = (proportions ** 2).sum(axis=-1)
+	with np.errstate(divide="ignore", invalid="ignore"):
+		return (p_observed - p_expected) / (1 - p_expected)
+
+"""
+function: krippendorffs_alpha
+
+Per metric: Krippendorff's alpha (nominal), computed from the coincidence of answers within each item.
+"""
+def krippendorffs_alpha(counts):
+	n_item = counts.sum(axis=-1)
+	pairable = n_item > 1
+	counts = np.where(pairable[..., np.newaxis], counts, 0)
+	n_item = np.where(pairable, n_item, 0)
+
+	n_total = n_item.sum(axis=0)
+	with np.errstate(divide="ignore", invalid="ignore"):
+		item_disagreement = np.where(pairable, (n_item ** 2 - (counts ** 2).sum(axis=-1)) / (n_item - 1), 0)
+		observed_disagreement = item_disagreement.sum(axis=0) / n_total
+		category_totals = counts.sum(axis=0)
+		expected_disagreement = (n_total ** 2 - (category_totals ** 2).sum(axis=-1)) / (n_total * (n_total - 1))
+		return 1 - observed_disagreement / expected_disagreement
+
+"""
+function: rater_pairs
+
+Returns two index arrays (first, second) covering every pair of raters.
+"""
+def rater_pairs(n_raters):
+	return np.triu_indices(n_raters, k=1)
+
+"""
+function: pairwise_confusion
+
+Returns a (pairs x metrics x categories x categories) array of confusion matrices, one for every pair of
+raters and metric.
+"""
+def pairwise_confusion(ratings, n_categories):
+	first, second = rater_pairs(ratings.shape[0])
+	n_pairs, n_metrics = len(first), ratings.shape[2]
+	cell = ratings[first] * n_categories + ratings[second]
+	offsets = (np.arange(n_pairs)[:, np.newaxis, np.newaxis] * n_metrics + np.arange(n_metrics)) * n_categories ** 2
+	confusion = np.bincount((cell + offsets).ravel(), minlength=n_pairs * n_metrics * n_categories ** 2)
+	return confusion.reshape(n_pairs, n_metrics, n_categories, n_categories)
+
+"""
+function: cohens_kappa_from_confusion
+
+Cohen's kappa for each confusion matrix in the last two axes of `confusion`.
+"""
+def cohens_kappa_from_confusion(confusion):
+	total = confusion.sum(axis=(-2, -1))
+	p_observed = np.trace(confusion, axis1=-2, axis2=-1) / total
+	p_expected = (confusion.sum(axis=-1) * confusion.sum(axis=-2)).sum(axis=-1) / total ** 2
+	with np.errstate(divide="ignore", invalid="ignore"):
+		return (p_observed - p_expected) / (1 - p_expected)
+
+"""
+function: pairwise_cohens_kappa
+
+Per pair of raters and metric: Cohen's kappa. Returns a (pairs x metrics) array.
+"""
+def pairwise_cohens_kappa(ratings, n_categories):
+	return cohens_kappa_from_confusion(pairwise_confusion(ratings, n_categories))
+
+"""
+function: compute_agreement
+
+Computes every statistic for every metric in one pass.
+
+@param ratings: integer array of shape (raters, items, metrics)
+@param n_categories: the number of answer categories
+@param metric_names: the names of the metrics, in order
+@param rater_ids: the IDs of the raters, in order
+
+Returns two DataFrames: one row per metric with each statistic (including the mean pairwise Cohen's kappa),
+and one row per (rater pair, metric) with the pairwise Cohen's kappa.
+"""
+def compute_agreement(ratings, n_categories, metric_names, rater_ids):
+	counts = category_counts(ratings, n_categories)
+	pairwise = pairwise_cohens_kappa(ratings, n_categories)
+
+	summary = pd.DataFrame({
+		"observed_agreement": observed_agreement(counts),
+		"fleiss_kappa": fleiss_kappa(counts),
+		"mean_cohens_kappa": np.nanmean(pairwise, axis=0) if len(pairwise) else np.nan,
+		"krippendorffs_alpha": krippendorffs_alpha(counts)
+	}, index=pd.Index(metric_names, name="metric"))
+
+	first, second = rater_pairs(len(rater_ids))
+	rater_ids = np.asarray(list(rater_ids), dtype=object)
+	pairwise_df = pd.DataFrame({
+		"rater_1": np.repeat(rater_ids[first], len(metric_names)),
+		"rater_2": np.repeat(rater_ids[second], len(metric_names)),
+		"metric": np.tile(list(metric_names), len(first)),
+		"cohens_kappa": pairwise.ravel()
+	})
+	return summary, pairwise_df
+
+"""
+function: cluster_sums
+
+Reduces the ratings to per-cluster sufficient statistics, from which every agreement statistic can be
+recomputed for any (weighted) combination of clusters. Clusters are conversations: `clusters` gives the
+cluster index of each item, in [0, n_clusters).
+
+Returns a dict of arrays, each with a leading cluster axis.
+"""
+def cluster_sums(ratings, n_categories, clusters, n_clusters):
+	clusters = np.asarray(clusters)
+	counts = category_counts(ratings, n_categories)
+	item_agreement, n_item = _item_agreement(counts)
+	pairable = n_item > 1
+	pairable_counts = np.where(pairable[..., np.newaxis], counts, 0)
+	with np.errstate(divide="ignore", invalid="ignore"):
+		item_disagreement = np.where(pairable, (n_item ** 2 - (counts ** 2).sum(axis=-1)) / (n_item - 1), 0)
+
+	def per_cluster(values):
+		sums = np.zeros((n_clusters,) + values.shape[1:])
+		np.add.at(sums, clusters, values)
+		return sums
+
+	# pairwise confusion matrices, summed within each cluster
+	first, second = rater_pairs(ratings.shape[0])
+	n_pairs, n_metrics = len(first), ratings.shape[2]
+	cell = ratings[first] * n_categories + ratings[second]
+	offsets = ((clusters[np.newaxis, :, np.newaxis] * n_pairs + np.arange(n_pairs)[:, np.newaxis, np.newaxis]) * n_metrics + np.arange(n_metrics)) * n_categories ** 2
+	confusion = np.bincount((cell + offsets).ravel(), minlength=n_clusters * n_pairs * n_metrics * n_categories ** 2)
+
+	return {
+		"agreement": per_cluster(np.where(pairable, item_agreement, 0)),
+		"pairable_items": per_cluster(pairable.astype(float)),
+		"category_totals": per_cluster(counts),
+		"pairable_category_totals": per_cluster(pairable_counts),
+		"disagreement": per_cluster(item_disagreement),
+		"confusion": confusion.reshape(n_clusters, n_pairs, n_metrics, n_categories, n_categories).astype(float)
+	}
+
+"""
+function: statistics_from_sums
+
+Computes every statistic from summed sufficient statistics (as returned by cluster_sums, summed or weighted
+over clusters). The leading axis of each array is kept: pass the per-cluster sums directly to get one set of
+statistics per cluster, or a weighted sum per bootstrap replicate to get one set per replicate.
+"""
+def statistics_from_sums(sums):
+	with np.errstate(divide="ignore", invalid="ignore"):
+		p_observed = sums["agreement"] / sums["pairable_items"]
+
+		proportions = sums["category_totals"] / sums["category_totals"].sum(axis=-1, keepdims=True)
+		p_expected = (proportions ** 2).sum(axis=-1)
+
+		n_total = sums["pairable_category_totals"].sum(axis=-1)
+		expected_disagreement = (n_total ** 2 - (sums["pairable_category_totals"] ** 2).sum(axis=-1)) / (n_total * (n_total - 1))
+
+		pairwise = cohens_kappa_from_confusion(sums["confusion"])
+		pairwise_rated = ~np.isnan(pairwise)
+		mean_pairwise = np.where(pairwise_rated, pairwise, 0).sum(axis=1) / pairwise_rated.sum(axis=1)
+
+		return {
+			"observed_agreement": p_observed,
+			"fleiss_kappa": (p_observed - p_expected) / (1 - p_expected),
+			"mean_cohens_kappa": mean_pairwise,
+			"krippendorffs_alpha": 1 - (sums["disagreement"] / n_total) / expected_disagreement,
+			"pairwise_cohens_kappa": pairwise
+		}
+
+def _bootstrap_chunk(args):
+	sums, n_replicates, seed = args
+	n_clusters = len(sums["agreement"])
+	rng = np.random.default_rng(seed)
+	# each row of `draws` is one replicate: the indices of the clusters resampled (with replacement)
+	draws = rng.integers(0, n_clusters, size=(n_replicates, n_clusters))
+	weights = np.bincount((draws + np.arange(n_replicates)[:, np.newaxis] * n_clusters).ravel(), minlength=n_replicates * n_clusters)
+	weights = weights.reshape(n_replicates, n_clusters).astype(float)
+	replicate_sums = {key: (weights @ value.reshape(n_clusters, -1)).reshape((n_replicates,) + value.shape[1:]) for key, value in sums.items()}
+	return statistics_from_sums(replicate_sums)
+
+"""
+function: bootstrap_statistics
+
+Cluster bootstrap: resamples whole clusters (conversations) with replacement, n_replicates times, and
+recomputes every statistic for each replicate. Replicates are drawn in chunks of chunk_size, which can be
+spread across n_jobs processes; the result only depends on the seed (not on n_jobs).
+
+Returns a dict of arrays, each with a leading replicate axis.
+"""
+def bootstrap_statistics(sums, n_replicates=1000, seed=19104, n_jobs=1, chunk_size=250):
+	chunk_sizes = [min(chunk_size, n_replicates - start) for start in range(0, n_replicates, chunk_size)]
+	seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+	tasks = [(sums, size, chunk_seed) for size, chunk_seed in zip(chunk_sizes, seeds)]
+	if(n_jobs > 1):
+		from concurrent.futures import ProcessPoolExecutor
+		with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+			results = list(pool.map(_bootstrap_chunk, tasks))
+	else:
+		results = [_bootstrap_chunk(task) for task in tasks]
+	return {key: np.concatenate([result[key] for result in results]) for key in results[0]}
+
+"""
+function: bootstrap_intervals
+
+Summarizes bootstrap replicates as percentile confidence intervals around the point estimates.
+
+Returns two DataFrames: one row per (metric, statistic), and one row per (rater pair, metric) for the
+pairwise Cohen's kappa.
+"""
+def bootstrap_intervals(sums, replicates, metric_names, rater_ids, level=0.95):
+	point = statistics_from_sums({key: value.sum(axis=0, keepdims=True) for key, value in sums.items()})
+	quantiles = [(1 - level) / 2, 1 - (1 - level) / 2]
+
+	rows = []
+	for statistic in ["observed_agreement", "fleiss_kappa", "mean_cohens_kappa", "krippendorffs_alpha"]:
+		low, high = np.nanquantile(replicates[statistic], quantiles, axis=0)
+		rows.append(pd.DataFrame({"metric": metric_names, "statistic": statistic, "estimate": point[statistic][0], "ci_low": low, "ci_high": high}))
+	summary = pd.concat(rows, ignore_index=True)
+
+	first, second = rater_pairs(len(rater_ids))
+	rater_ids = np.asarray(list(rater_ids), dtype=object)
+	low, high = np.nanquantile(replicates["pairwise_cohens_kappa"], quantiles, axis=0)
+	pairwise = pd.DataFrame({
+		"rater_1": np.repeat(rater_ids[first], len(metric_names)),
+		"rater_2": np.repeat(rater_ids[second], len(metric_names)),
+		"metric": np.tile(list(metric_names), len(first)),
+		"estimate": point["pairwise_cohens_kappa"][0].ravel(),
+		"ci_low": low.ravel(),
+		"ci_high": high.ravel()
+	})
+	return summary, pairwise
+
+"""
+function: agreement_breakdowns
+
+Breaks agreement down per conversation, per rater pair, and per label category.
+
+@param ratings: integer array of shape (raters, items, metrics)
+@param n_categories: the number of answer categories
+@param conversation_ids: the CONV_ID of each item
+@param metric_names: the names of the metrics, in order
+@param rater_ids: the IDs of the raters, in order
+@param category_labels: for each metric, a dict from category to a readable label
+
+Returns a dict of DataFrames: per_conversation, per_rater_pair, and per_category.
+"""
+def agreement_breakdowns(ratings, n_categories, conversation_ids, metric_names, rater_ids, category_labels):
+	conversations, clusters = np.unique(np.asarray(conversation_ids).astype(str), return_inverse=True)
+	sums = cluster_sums(ratings, n_categories, clusters, len(conversations))
+	n_metrics = len(metric_names)
+
+	# per conversation: every statistic, computed within each conversation
+	per_cluster = statistics_from_sums(sums)
+	per_conversation = pd.DataFrame({
+		"CONV_ID": np.repeat(conversations, n_metrics),
+		"metric": np.tile(list(metric_names), len(conversations)),
+		"n_messages": np.bincount(clusters, minlength=len(conversations)).repeat(n_metrics),
+		**{statistic: per_cluster[statistic].ravel() for statistic in ["observed_agreement", "fleiss_kappa", "mean_cohens_kappa", "krippendorffs_alpha"]}
+	})
+
+	# per rater pair: percent agreement and Cohen's kappa
+	confusion = sums["confusion"].sum(axis=0)
+	first, second = rater_pairs(len(rater_ids))
+	rater_ids = np.asarray(list(rater_ids), dtype=object)
+	per_rater_pair = pd.DataFrame({
+		"rater_1": np.repeat(rater_ids[first], n_metrics),
+		"rater_2": np.repeat(rater_ids[second], n_metrics),
+		"metric": np.tile(list(metric_names), len(first)),
+		"percent_agreement": (np.trace(confusion, axis1=-2, axis2=-1) / confusion.sum(axis=(-2, -1))).ravel(),
+		"cohens_kappa": cohens_kappa_from_confusion(confusion).ravel()
+	})
+
+	# per label category: how often it is used, specific agreement, and Fleiss' category kappa
+	counts = category_counts(ratings, n_categories).astype(float)
+	n_item = counts.sum(axis=-1, keepdims=True)
+	with np.errstate(divide="ignore", invalid="ignore"):
+		share = counts.sum(axis=0) / n_item.sum(axis=0)
+		specific_agreement = (counts * (counts - 1)).sum(axis=0) / (counts * (n_item - 1)).sum(axis=0)
+		category_kappa = 1 - (counts * (n_item - counts)).sum(axis=0) / ((n_item * (n_item - 1)).sum(axis=0) * share * (1 - share))
+	per_category = pd.DataFrame({
+		"metric": np.repeat(list(metric_names), n_categories),
+		"category": np.tile(np.arange(n_categories), n_metrics),
+		"label": [category_labels[m].get(k, "") for m in range(n_metrics) for k in range(n_categories)],
+		"share": share.ravel(),
+		"specific_agreement": specific_agreement.ravel(),
+		"category_kappa": category_kappa.ravel()
+	})
+
+	return {"per_conversation": per_conversation, "per_rater_pair": per_rater_pair, "per_category": per_category}
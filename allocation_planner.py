@@ -0,0 +1,138 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+try:
+	import fcntl
+except ImportError: # not available on Windows
+	fcntl = None
+
+"""
+Planning allocations of conversations to several raters at once.
+
+A batch plan is a JSON file like:
+
+	{
+		"overlap": 0.2,
+		"raters": {
+			"amy": {"n_convos": 30, "max_messages": 400},
+			"helena": {"n_convos": 30}
+		}
+	}
+
+- n_convos: the number of new conversations to give the rater
+- max_messages (optional): the most messages (sheet rows) the rater should be given in this batch
+- overlap (optional, default 0): the share of conversations (of the smallest n_convos in the plan) that every
+  rater in the batch is given, for checking IRR. The rest of each rater's conversations are given to no
+  other rater in the batch, and were not given to any of them before (in an earlier batch), so that the
+  overlap between the raters stays at what the plan asks for.
+
+Conversations are always taken in the constant, but random, order of corpus.get_conversation_ids(), skipping
+those already allocated to the rater. A rater's allocation stops at their message budget, rather than
+skipping long conversations, so that budgets never bias the sample towards short conversations.
+
+Which conversations each rater has been allocated is kept in an index (ALLOCATION_INDEX_PATH) that is
+brought up to date from just the log entries written since it was last saved.
+"""
+ALLOCATION_INDEX_PATH = './CONFLICT_CONVO_ALLOCATION_INDEX.json'
+
+"""
+function: load_plan
+
+Reads a batch plan (see above) and checks that it only names known raters.
+"""
+def load_plan(path, known_raters):
+	with open(path) as f:
+		plan = json.load(f)
+	if(not plan.get("raters")):
+		raise ValueError('The plan in ' + path + ' does not list any raters.')
+	unknown = [rater_id for rater_id in plan["raters"] if rater_id not in known_raters]
+	if(unknown):
+		raise ValueError('The plan in ' + path + ' names raters without a rating sheet: ' + ", ".join(unknown))
+	if(not 0 <= plan.get("overlap", 0) <= 1):
+		raise ValueError('The overlap in ' + path + ' must be between 0 and 1.')
+	return plan
+
+"""
+function: load_allocation_index
+
+Returns {rater_id: set of allocated CONV_IDs}, updated with the entries written to label_log since the index
+was last saved (or rebuilt from the whole log, if the index was built from a different log, or the log has
+been replaced or edited since; see read_since).
+"""
+def load_allocation_index(label_log, path=ALLOCATION_INDEX_PATH):
+	log_name = type(label_log).__name__ + ":" + label_log.path
+	# held while the index is brought up to date and saved, so that scheduler runs in parallel never read a
+	# half-written index, or overwrite each other's updates
+	with open(path + ".lock", "w") as lock:
+		if(fcntl is not None):
+			fcntl.flock(lock, fcntl.LOCK_EX)
+		stored = {}
+		if(os.path.isfile(path)):
+			with open(path) as f:
+				stored = json.load(f)
+		position = stored.get("position") if stored.get("log") == log_name else None
+
+		entries, position, complete = label_log.read_since(position)
+		allocated = {} if complete else {rater_id: set(conv_ids) for rater_id, conv_ids in stored["allocated"].items()}
+		for rater_id, conv_ids in entries.groupby("rater_id")["CONV_ID"]:
+			allocated.setdefault(rater_id, set()).update(conv_ids)
+
+		tmp_path = path + ".tmp"
+		with open(tmp_path, "w") as f:
+			json.dump({"log": log_name, "position": position, "allocated": {rater_id: sorted(conv_ids) for rater_id, conv_ids in allocated.items()}}, f)
+		os.replace(tmp_path, path)
+	return allocated
+
+"""
+function: allocation_mask
+
+Returns a (raters x conversations) boolean array: whether each conversation (in the order of conversation_ids)
+has already been allocated to each rater.
+"""
+def allocation_mask(allocated, rater_ids, conversation_ids):
+	conversation_ids = pd.Index(conversation_ids)
+	mask = np.zeros((len(rater_ids), len(conversation_ids)), dtype=bool)
+	for r, rater_id in enumerate(rater_ids):
+		indices = conversation_ids.get_indexer(list(allocated.get(rater_id, ())))
+		mask[r, indices[indices >= 0]] = True
+	return mask
+
+def _take_prefix(candidates, n, lengths, budget):
+	candidates = candidates[:max(n, 0)]
+	return candidates[:np.searchsorted(np.cumsum(lengths[candidates]), budget, side="right")]
+
+"""
+function: plan_allocations
+
+Chooses the conversations for each rater in the batch.
+
+@param allocated: (raters x conversations) boolean array, from allocation_mask
+@param n_convos: the number of conversations to give each rater
+@param lengths: the number of messages in each conversation
+@param overlap: the share of conversations (of the smallest n_convos) that every rater is given
+@param max_messages: the message budget of each rater (np.inf for no budget)
+
+Returns (shared, own): the conversation indices given to every rater, and a list with the indices given
+to each rater alone.
+"""
+def plan_allocations(allocated, n_convos, lengths, overlap=0.0, max_messages=None):
+	n_raters, n_conversations = allocated.shape
+	n_convos = np.asarray(n_convos)
+	budgets = np.full(n_raters, np.inf) if max_messages is None else np.asarray(max_messages, dtype=float)
+
+	# conversations that every rater gets must be new to all of them
+	n_shared = int(round(overlap * n_convos.min())) if n_raters > 1 else 0
+	shared = _take_prefix(np.flatnonzero(~allocated.any(axis=0)), n_shared, lengths, budgets.min())
+	taken = np.zeros(n_conversations, dtype=bool)
+	taken[shared] = True
+	budgets = budgets - lengths[shared].sum()
+
+	# a rater's own conversations must also be new to all of them, or earlier batches would add to the overlap
+	own_pool = ~allocated.any(axis=0)
+	own = []
+	for r in range(n_raters):
+		rater_own = _take_prefix(np.flatnonzero(own_pool & ~taken), n_convos[r] - len(shared), lengths, budgets[r])
+		taken[rater_own] = True
+		own.append(rater_own)
+	return shared, own
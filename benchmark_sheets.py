@@ -0,0 +1,160 @@
+import argparse
+import contextlib
+import io
+import os
+import random
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import sheet_client
+from fake_sheets import FakeClient
+from rating_dictionary import RATING_DICTIONARY
+
+"""
+Benchmarks the scheduler and the IRR check against the in-process fake of Google Sheets (see fake_sheets.py),
+reporting the wall time and the number of API calls of each workflow:
+- schedule: allocating conversations (`messages` messages) to each rater with schedule()
+- update: syncing each rater's (fully rated) sheet back into the log with update()
+- irr_cold: reading every rater's sheet and computing the agreement statistics and disagreed messages, with
+  an empty sheet snapshot cache
+- irr_warm: the same again, with the snapshots cached by irr_cold
+
+for every combination of --messages and --raters. Each combination runs in a fresh temporary directory, with a
+synthetic corpus of conversations of CONVERSATION_LENGTH messages, so nothing in the working directory (log,
+sync state, caches) is touched.
+
+Raters answer at random, agreeing with a shared answer RATER_AGREEMENT of the time. By default the sheet
+snapshot cache has a TTL of 0, so reads of unchanged sheets are served from the cache after a single revision
+check.
+"""
+MESSAGES = [10, 100, 1000]
+RATERS = [2, 4, 16]
+CONVERSATION_LENGTH = 10
+N_CONVERSATIONS = 500
+RATER_AGREEMENT = 0.8
+SEED = 19104
+
+def write_corpus(n_conversations=N_CONVERSATIONS, conversation_length=CONVERSATION_LENGTH):
+	os.makedirs("./conflict_reddit_data/full_data", exist_ok=True)
+	for name, prefix in [("conversations_gone_awry", "awry"), ("winning_conversations", "winning")]:
+		n = n_conversations // 2
+		conv_ids = np.repeat([prefix + str(i) for i in range(n)], conversation_length)
+		pd.DataFrame({
+			"CONV_ID": conv_ids,
+			"text": ["message " + str(i) for i in range(len(conv_ids))],
+			"speaker": ["speaker" + str(i % 7) for i in range(len(conv_ids))],
+			"id": [conv_id + "_" + str(i) for i, conv_id in enumerate(conv_ids)],
+			"timestamp": np.arange(len(conv_ids)),
+			"meta.score": 1,
+			"reply_to": "",
+			"conversation_length": conversation_length
+		}).to_csv("./conflict_reddit_data/full_data/" + name + ".csv", index=False)
+
+"""
+function: rate_sheets
+
+Fills in every allocated row of each rater's fake sheet (without counting API calls).
+"""
+def rate_sheets(fake, rater_ids, rating_options, seed=SEED):
+	rng = random.Random(seed)
+	sheets = [fake.spreadsheets[url.split("/d/")[1]].worksheets[0] for url in (RATING_DICTIONARY[rater_id] for rater_id in rater_ids)]
+	n_rows = max(sh._last_row(1, 1) for sh in sheets)
+	shared = [[rng.choice(options) for options in rating_options] for _ in range(n_rows)]
+	for sh in sheets:
+		answers = [[answer if rng.random() < RATER_AGREEMENT else rng.choice(options) for answer, options in zip(row, rating_options)] for row in shared]
+		sh.set_values("E3", answers[2:sh._last_row(1, 1)])
+
+def run_irr(irr_conflict, rater_ids):
+	from agreement_engine import encode_ratings, category_counts, compute_agreement
+	blocks = irr_conflict.get_rating_blocks([RATING_DICTIONARY[rater_id] for rater_id in rater_ids])
+	rows = irr_conflict.shared_rated_rows(blocks)
+	answers = irr_conflict.get_answers(blocks, rows)
+	ratings = encode_ratings(answers, [metric["conversion"] for metric in irr_conflict.METRICS.values()])
+	compute_agreement(ratings, irr_conflict.N_CATEGORIES, list(irr_conflict.METRICS), rater_ids)
+	counts = category_counts(ratings, irr_conflict.N_CATEGORIES)
+	for metric_index, metric in enumerate(irr_conflict.METRICS):
+		irr_conflict.get_disagreed_messages(counts[:, metric_index, :], answers[:, :, metric_index].tolist(), blocks, rows, metric, rater_ids)
+
+"""
+function: benchmark
+
+Runs the workflows for n_messages per rater and n_raters raters; returns one result row per workflow.
+"""
+def benchmark(n_messages, n_raters, latency=0.0, quota_error_rate=0.0, cache_ttl=0):
+	start_dir = os.getcwd()
+	with tempfile.TemporaryDirectory() as workdir:
+		os.chdir(workdir)
+		try:
+			results = run_workflows(workdir, n_messages, n_raters, latency, quota_error_rate, cache_ttl)
+		finally:
+			os.chdir(start_dir)
+	return results
+
+"""
+function: run_workflows
+
+Sets up the corpus, log, cache and fake sheets in workdir (the current directory), then times each workflow.
+"""
+def run_workflows(workdir, n_messages, n_raters, latency, quota_error_rate, cache_ttl):
+	write_corpus()
+
+	# the scripts keep their state in the working directory, so (re)load them here
+	import corpus
+	import labeling_log
+	import conflict_rating_scheduler as scheduler
+	import irr_conflict
+	corpus._index = None
+	scheduler.LABEL_LOG = labeling_log.open_label_log("csv")
+	sheet_client.SHEET_CACHE = sheet_client.SheetCache(cache_dir=os.path.join(workdir, ".sheet_cache"), ttl=cache_ttl)
+
+	fake = FakeClient(latency=latency, quota_error_rate=quota_error_rate, seed=SEED)
+	sheet_client.set_client(fake)
+	rater_ids = ["rater" + str(i) for i in range(n_raters)]
+	RATING_DICTIONARY.clear()
+	for rater_id in rater_ids:
+		RATING_DICTIONARY[rater_id] = "https://docs.google.com/spreadsheets/d/fake-" + rater_id
+		fake.create_spreadsheet(RATING_DICTIONARY[rater_id]).worksheets[0].set_values("A1", [["CONV_ID", "id", "speaker", "text"], ["", "", "", ""]])
+
+	def timed(workflow, fn):
+		fake.reset_calls()
+		start = time.perf_counter()
+		with contextlib.redirect_stdout(io.StringIO()):
+			fn()
+		return {
+			"workflow": workflow, "messages": n_messages, "raters": n_raters,
+			"wall_s": round(time.perf_counter() - start, 4),
+			"api_calls": sum(fake.calls.values()),
+			"quota_errors": sum(fake.errors.values()),
+			"calls_by_method": " ".join(method + "=" + str(count) for method, count in sorted(fake.calls.items()))
+		}
+
+	n_convos = max(1, n_messages // CONVERSATION_LENGTH)
+	results = [timed("schedule", lambda: [scheduler.schedule(rater_id, n_convos) for rater_id in rater_ids])]
+	rate_sheets(fake, rater_ids, list(scheduler.RATING_OPTIONS.values()))
+	results.append(timed("update", lambda: [scheduler.update(rater_id) for rater_id in rater_ids]))
+	# the update just cached every sheet, so IRR is timed first with an empty cache of its own, then again with it
+	sheet_client.SHEET_CACHE = sheet_client.SheetCache(cache_dir=os.path.join(workdir, ".sheet_cache_irr"), ttl=cache_ttl)
+	results.append(timed("irr_cold", lambda: run_irr(irr_conflict, rater_ids)))
+	results.append(timed("irr_warm", lambda: run_irr(irr_conflict, rater_ids)))
+	return results
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description='Benchmarks the API calls and wall time of scheduling, updating, and checking IRR, against a local fake of Google Sheets.')
+	parser.add_argument('--messages', type=int, nargs='+', default=MESSAGES, help='Messages allocated to each rater (default: %(default)s).')
+	parser.add_argument('--raters', type=int, nargs='+', default=RATERS, help='Numbers of raters (default: %(default)s).')
+	parser.add_argument('--latency', type=float, default=0.0, help='Seconds that every fake API call takes (default: %(default)s).')
+	parser.add_argument('--quota-error-rate', type=float, default=0.0, help='Share of fake API calls that fail with a 429 quota error (default: %(default)s).')
+	parser.add_argument('--cache-ttl', type=float, default=0, help='TTL of the sheet snapshot cache (default: %(default)s, so that every read at least checks whether the sheet changed).')
+	parser.add_argument('--output', help='Also save the results to this CSV file.')
+	args = parser.parse_args()
+
+	# measure the calls themselves, not the real quota: lift the rate limits and shorten the retry backoff
+	sheet_client.configure_quota(reads_per_minute=10 ** 9, writes_per_minute=10 ** 9)
+	sheet_client.BACKOFF_BASE = 0.01
+
+	results = pd.DataFrame([row for n_messages in args.messages for n_raters in args.raters for row in benchmark(n_messages, n_raters, args.latency, args.quota_error_rate, args.cache_ttl)])
+	print(results.to_string(index=False))
+	if args.output:
+		results.to_csv(args.output, index=False)
@@ -1,45 +1,26 @@
 import pandas as pd
 import numpy as np
-import gspread
-import random
 import os
+from concurrent.futures import ThreadPoolExecutor
 import argparse
-import time
-from gspread_formatting import *
 from rating_dictionary import RATING_DICTIONARY
-
-# Authenticating with Google Sheeets
+from labeling_log import open_label_log
+import sheet_client
+from sheet_client import get_client, read_sheet_range
+from sync_state import load_sync_state, save_sync_state, get_rater_state, block_start_for_row, hash_block, next_available_row, set_filled_row, BLOCK_SIZE, FIRST_DATA_ROW
+from corpus import get_conversation_ids, get_conversation_lengths, get_conversations_by_id
+from tracing import TRACER, report
+from consensus import build_consensus, update_consensus, CONSENSUS_PATH
+from allocation_planner import load_plan, load_allocation_index, allocation_mask, plan_allocations
+
+# Google Sheets are accessed through sheet_client, which authenticates lazily (on the first API call)
 # Service Email: tpm-data-annotation@tpm-data-annotation.iam.gserviceaccount.com
-gc = gspread.service_account(filename='./tpm-data-annotation-aae74b403ab4.json')
-
-# Read in the conversations
-AWRY = pd.read_csv('./conflict_reddit_data/full_data/conversations_gone_awry.csv', dtype={'timestamp': 'Int64', 'meta.score': 'Int64'})
-WINNNING = pd.read_csv('./conflict_reddit_data/full_data/winning_conversations.csv', dtype={'timestamp': 'Int64', 'meta.score': 'Int64'})
-CONVERSATIONS = pd.concat([AWRY, WINNNING], axis=0)
-
-"""
-Check for the conversation labeling log and create one if it doesn't exist
-The conversation labeling log stores all of the samples that we have allocated to users, 
-as well as the latest ratings.
-
-Here's what each column in the conversation log should contain:
-- CONV_ID: the id associated with the conversation
-- id: the id associated with each message/chat
-- rating_directness_content: the rating for directness assigned by the rater (content)
-- rating_directness_expression: the rating for directness assigned by the rater (expression)
-- rating_OI_content: the rating for directness assigned by the rater (content)
-- rating_OI_expression: the rating for directness assigned by the rater (expression)
-- rater_id: the userid of the rater
-- status: {allocated, done}
-- last_updated_time: time associated with the last update / check to this log item
-""" 
-CONVERSATION_LABELING_LOG_PATH = './CONFLICT_CONVO_LABELING_LOG.csv'
-if(not os.path.isfile(CONVERSATION_LABELING_LOG_PATH)):
-	# define a simple CSV with just the headers
-	log_setup = pd.DataFrame(columns = ["CONV_ID", "id", "rating_directness_content", "rating_directness_expression", "rating_OI_content", "rating_OI_expression", "rater_id", "status", "last_updated_time"])
-	log_setup.to_csv(CONVERSATION_LABELING_LOG_PATH, index=False)
-
-LABEL_LOG = pd.read_csv(CONVERSATION_LABELING_LOG_PATH)
+
+# The conversations are loaded lazily from the corpus cache (see corpus.py), only when scheduling
+
+# The conversation labeling log (see labeling_log.py for its columns and backends).
+# The backend can be chosen with the CONFLICT_LOG_BACKEND environment variable or --log-backend.
+LABEL_LOG = open_label_log(os.environ.get("CONFLICT_LOG_BACKEND", "csv"))
 
 # Constants for where directness and oppositional intensity are rated
 DIRECTNESS_CONTENT_COL = "E"
@@ -47,11 +28,23 @@ DIRECTNESS_EXPRESSION_COL = "F"
 OI_CONTENT_COL = "G"
 OI_EXPRESSION_COL = "H"
 
-# Define a constant, but random, ordering for the conversations
-random.seed(19104)
-CONVERSATION_IDS = list(set(CONVERSATIONS["CONV_ID"]))
-CONVERSATION_IDS.sort()
-random.shuffle(CONVERSATION_IDS)
+# Layout of columns A-H in each rater's sheet, and the log columns holding the ratings
+SHEET_COLUMNS = ["CONV_ID", "id", "speaker", "text", "rating_directness_content", "rating_directness_expression", "rating_OI_content", "rating_OI_expression"]
+RATING_COLUMNS = SHEET_COLUMNS[4:]
+
+# The drop-down options for each rating column
+RATING_OPTIONS = {
+	DIRECTNESS_CONTENT_COL: ["Yes - Direct Content", "Neutral - Content contains no opinion", "No - Indirect Content"],
+	DIRECTNESS_EXPRESSION_COL: ["Yes - Direct Expression", "No - Indirect Expression"],
+	OI_CONTENT_COL: ["Yes - Content opposes someone else", "No - Content does not oppose anyone"],
+	OI_EXPRESSION_COL: ["Yes - Expression is emotional/forceful", "No - Expression is not emotional/forceful"]
+}
+
+# The most message text (in bytes) sent in a single batchUpdate call; larger samples are split across calls
+MAX_BATCH_BYTES = 2000000
+
+def column_index(col):
+	return ord(col) - ord("A")
 
 """
 function: update_log_allocated
@@ -66,93 +59,106 @@ def update_log_allocated(sample_to_label, rater_id):
 		"rating_OI_expression": pd.Series(['-']).repeat(len(sample_to_label)),
 		"rater_id": pd.Series([rater_id]).repeat(len(sample_to_label)),
 		"status": pd.Series(['allocated']).repeat(len(sample_to_label)),
-		"last_updated_time": pd.Series([pd.Timestamp.now()]).repeat(len(sample_to_label))
+		"last_updated_time": pd.Series([str(pd.Timestamp.now())]).repeat(len(sample_to_label))
 	}
 	sample_to_label_reset = sample_to_label[["CONV_ID", "id"]].reset_index(drop=True)
 	static_data_reset = pd.DataFrame(static_data).reset_index(drop=True)
 	new_data = pd.concat([sample_to_label_reset, static_data_reset], axis=1)
-	# Append the new data to the existing DataFrame
-	log_setup = pd.read_csv(CONVERSATION_LABELING_LOG_PATH)
-	updated_data = new_data.copy() if log_setup.empty else pd.concat([log_setup, new_data], ignore_index=True)
-	updated_data.to_csv(CONVERSATION_LABELING_LOG_PATH, index=False)
+	# Append the new entries to the log
+	with TRACER.stage("log write"):
+		LABEL_LOG.upsert(new_data)
 
-	# also update LABEL_LOG
-	LABEL_LOG = updated_data
+"""
+function: rating_validation_requests
 
-def next_available_row(worksheet):
-	# Modified from: https://stackoverflow.com/questions/40781295/how-to-find-the-first-empty-row-of-a-google-spread-sheet-using-python-gspread
-	str_list = list(filter(None, worksheet.col_values(1)))
-	return len(str_list)+2
+Returns the batchUpdate requests that add the rating drop-downs (columns E-H) to rows first_row-last_row.
+"""
+def rating_validation_requests(sheet_id, first_row, last_row):
+	return([{"setDataValidation": {
+		"range": {"sheetId": sheet_id, "startRowIndex": first_row - 1, "endRowIndex": last_row, "startColumnIndex": column_index(col), "endColumnIndex": column_index(col) + 1},
+		"rule": {"condition": {"type": "ONE_OF_LIST", "values": [{"userEnteredValue": option} for option in options]}, "showCustomUi": True}
+	}} for col, options in RATING_OPTIONS.items()])
 
 """
-function: write_sample_to_sheet
+function: message_value_request
 
-Given a sample to label, write it to the Google Sheet specific to the user in question.
+Returns the batchUpdate request that writes rows of (CONV_ID, id, speaker, text) to columns A-D, from start_row down.
 """
-def write_sample_to_sheet(sample_to_label, rater_id):
-	rater_sheet = RATING_DICTIONARY[rater_id]
-	sh = gc.open_by_url(rater_sheet).sheet1
+def message_value_request(sheet_id, start_row, rows):
+	return({"updateCells": {
+		"start": {"sheetId": sheet_id, "rowIndex": start_row - 1, "columnIndex": 0},
+		"rows": [{"values": [{"userEnteredValue": {"stringValue": value}} for value in row]} for row in rows],
+		"fields": "userEnteredValue"
+	}})
 
-	available_row = next_available_row(sh) # Figure out the next open line
-	update_range_CONV_ID = sh.range("A{}:A{}".format(available_row, available_row + len(sample_to_label)))
-	update_range_id = sh.range("B{}:B{}".format(available_row, available_row + len(sample_to_label)))
-	update_range_speaker = sh.range("C{}:C{}".format(available_row, available_row + len(sample_to_label)))
-	update_range_text = sh.range("D{}:D{}".format(available_row, available_row + len(sample_to_label)))
-	
-	# Convert values to strings if needed
-	CONV_IDS_to_udpate = [str(value) for value in list(sample_to_label["CONV_ID"])]
-	ids_to_udpate = [str(value) for value in list(sample_to_label["id"])]
-	speakers_to_udpate = [str(value) for value in list(sample_to_label["speaker"])]
-	text_values_to_update = [str(value) for value in list(sample_to_label["text"])]
-
-	# Update the values in the range
-	for i in range(len(sample_to_label)):
-		update_range_CONV_ID[i].value = CONV_IDS_to_udpate[i]
-		update_range_id[i].value = ids_to_udpate[i]
-		update_range_speaker[i].value = speakers_to_udpate[i]
-		update_range_text[i].value = text_values_to_update[i]
-
-	# Batch update the range
-	sh.update_cells(update_range_CONV_ID)
-	sh.update_cells(update_range_id)
-	sh.update_cells(update_range_speaker)
-	sh.update_cells(update_range_text)
-	
-	# Update the formatting for the next columns
-	validation_rule_directness_content = DataValidationRule(
-	BooleanCondition('ONE_OF_LIST', ["Yes - Direct Content", "Neutral - Content contains no opinion", "No - Indirect Content"]),
-		showCustomUi=True
-	)
-	set_data_validation_for_cell_range(sh, DIRECTNESS_CONTENT_COL + str(available_row) + ":" + DIRECTNESS_CONTENT_COL + str(available_row + len(sample_to_label)), validation_rule_directness_content)
+"""
+function: chunk_rows
 
-	validation_rule_directness_expression = DataValidationRule(
-	BooleanCondition('ONE_OF_LIST', ["Yes - Direct Expression", "No - Indirect Expression"]),
-		showCustomUi=True
-	)
-	set_data_validation_for_cell_range(sh, DIRECTNESS_EXPRESSION_COL + str(available_row) + ":" + DIRECTNESS_EXPRESSION_COL + str(available_row + len(sample_to_label)), validation_rule_directness_expression)
+Splits rows into consecutive chunks of at most max_bytes of cell text each (a single row is never split).
+"""
+def chunk_rows(rows, max_bytes=MAX_BATCH_BYTES):
+	chunk, chunk_bytes = [], 0
+	for row in rows:
+		row_bytes = sum(len(value.encode("utf-8")) for value in row)
+		if(chunk and chunk_bytes + row_bytes > max_bytes):
+			yield chunk
+			chunk, chunk_bytes = [], 0
+		chunk.append(row)
+		chunk_bytes += row_bytes
+	if(chunk):
+		yield chunk
 
-	validation_rule_OI_content = DataValidationRule(
-	BooleanCondition('ONE_OF_LIST', ["Yes - Content opposes someone else", "No - Content does not oppose anyone"]),
-		showCustomUi=True
-	)
-	set_data_validation_for_cell_range(sh, OI_CONTENT_COL + str(available_row) + ":" + OI_CONTENT_COL + str(available_row + len(sample_to_label)), validation_rule_OI_content)
+"""
+function: write_sample_to_sheet
 
-	validation_rule_OI_expression = DataValidationRule(
-	BooleanCondition('ONE_OF_LIST', ["Yes - Expression is emotional/forceful", "No - Expression is not emotional/forceful"]),
-		showCustomUi=True
-	)
-	set_data_validation_for_cell_range(sh, OI_EXPRESSION_COL + str(available_row) + ":" + OI_EXPRESSION_COL + str(available_row + len(sample_to_label)), validation_rule_OI_expression)
+Given a sample to label, write it to the Google Sheet specific to the user in question.
 
+The messages (columns A-D) and the rating drop-downs (columns E-H) are written together in a single
+spreadsheets.batchUpdate call (split into several calls only for very large samples, see MAX_BATCH_BYTES).
+The drop-downs are only added to rows past the rater's `validated_through` row, and the next open row is
+taken from the rater's cursor (see sync_state.py) rather than by scanning the sheet. With the spreadsheet
+open, a schedule makes one metadata call (for the worksheet and the cursor check) before its batchUpdate.
+"""
+def write_sample_to_sheet(sample_to_label, rater_id):
+	rater_sheet = RATING_DICTIONARY[rater_id]
+	spreadsheet = get_client().open_by_url(rater_sheet)
+	# the cached snapshots of this sheet are about to go stale
+	sheet_client.SHEET_CACHE.invalidate(rater_sheet)
+	sync_state = load_sync_state()
+	rater_state = get_rater_state(sync_state, rater_id)
 
+	sheet_id, grid_rows, available_row = next_available_row(spreadsheet, rater_state) # Figure out the next open line
+	# Convert values to strings if needed
+	rows = [[str(value) for value in row] for row in sample_to_label[SHEET_COLUMNS[:4]].itertuples(index=False)]
+
+	for chunk in chunk_rows(rows):
+		last_row = available_row + len(chunk) - 1
+		requests = []
+		if(last_row > grid_rows): # grow the sheet if the sample runs past its last row
+			requests.append({"appendDimension": {"sheetId": sheet_id, "dimension": "ROWS", "length": last_row - grid_rows}})
+			grid_rows = last_row
+		requests.append(message_value_request(sheet_id, available_row, chunk))
+		if(last_row > rater_state["validated_through"]):
+			requests += rating_validation_requests(sheet_id, max(available_row, rater_state["validated_through"] + 1), last_row)
+			rater_state["validated_through"] = last_row
+		spreadsheet.batch_update({"requests": requests})
+		available_row = last_row + 1
+		# save the cursor after every call, so that a failed run never leaves it behind the sheet
+		set_filled_row(rater_state, last_row, grid_rows)
+		save_sync_state(sync_state, rater_id=rater_id)
 
-def get_n_convos_to_rate(conversations_for_rater, n_convos, rater_id):
-	# Identify conversations that have already been labeled
-	already_labeled_ids = set(conversations_for_rater["CONV_ID"])
-	df_to_label = [conversation_id for conversation_id in CONVERSATION_IDS if conversation_id not in already_labeled_ids]
-	n_convo_ids = df_to_label[:n_convos]
-	sample_to_label = CONVERSATIONS[CONVERSATIONS["CONV_ID"].isin(n_convo_ids)]
+"""
+function: get_n_convos_to_rate
 
-	return(sample_to_label)
+Chooses the next n_convos conversations for rater_id with the allocation planner, as schedule_batch does for
+a batch of raters, so both take conversations in the same order and skip the same ones.
+"""
+def get_n_convos_to_rate(n_convos, rater_id):
+	conversation_ids = np.array(get_conversation_ids())
+	allocated = allocation_mask(load_allocation_index(LABEL_LOG), [rater_id], conversation_ids)
+	shared, own = plan_allocations(allocated, [n_convos], get_conversation_lengths())
+	# only the rows of the chosen conversations are read from the corpus
+	return(get_conversations_by_id(conversation_ids[own[0]]))
 
 """
 function: schedule
@@ -161,72 +167,159 @@ Allocates n_convos to the spreadsheet of rater_id.
 """
 def schedule(rater_id, n_convos):
 	# check whether user has any allocated but incomplete conversations
-	conversations_for_rater = LABEL_LOG[LABEL_LOG["rater_id"]==rater_id]
+	with TRACER.stage("log read"):
+		conversations_for_rater = LABEL_LOG.read(rater_id=rater_id)
 	if(conversations_for_rater[conversations_for_rater["status"]=="allocated"].empty):
-		new_conversations = get_n_convos_to_rate(conversations_for_rater, n_convos, rater_id)
-		write_sample_to_sheet(new_conversations, rater_id)
+		with TRACER.stage("choose conversations"):
+			new_conversations = get_n_convos_to_rate(n_convos, rater_id)
+		with TRACER.stage("sheet write"):
+			write_sample_to_sheet(new_conversations, rater_id)
 		update_log_allocated(new_conversations, rater_id)
 		print("Updated rating sheet for " + str(rater_id) + " with " + str(n_convos) + " new conversations!")
 	else:
 		print("Rating sheet for " + str(rater_id) + " contains unlabeled conversations. Please either complete ratings or update the log.")		
 
+"""
+function: schedule_batch
 
+Allocates conversations to several raters at once, following the plan in plan_path (see allocation_planner.py
+for its format), and writes all of their sheets concurrently. As with schedule, raters who still have
+allocated but incomplete conversations are skipped.
 """
-function: update
+def schedule_batch(plan_path):
+	plan = load_plan(plan_path, RATING_DICTIONARY)
+	with TRACER.stage("log read"):
+		unfinished = set(LABEL_LOG.read(status="allocated")["rater_id"])
+	for rater_id in plan["raters"]:
+		if(rater_id in unfinished):
+			print("Rating sheet for " + str(rater_id) + " contains unlabeled conversations. Please either complete ratings or update the log.")
+	rater_ids = [rater_id for rater_id in plan["raters"] if rater_id not in unfinished]
+	if(not rater_ids):
+		return
+
+	with TRACER.stage("allocation index"):
+		conversation_ids = np.array(get_conversation_ids())
+		allocated = allocation_mask(load_allocation_index(LABEL_LOG), rater_ids, conversation_ids)
+	with TRACER.stage("plan"):
+		shared, own = plan_allocations(
+			allocated,
+			[plan["raters"][rater_id]["n_convos"] for rater_id in rater_ids],
+			get_conversation_lengths(),
+			overlap=plan.get("overlap", 0),
+			max_messages=[plan["raters"][rater_id].get("max_messages", np.inf) for rater_id in rater_ids]
+		)
+	with TRACER.stage("corpus read"):
+		# the shared conversations come first (in the same order) on every sheet; IRR matches them across sheets by (CONV_ID, id)
+		shared_sample = get_conversations_by_id(conversation_ids[shared])
+		samples = {rater_id: pd.concat([shared_sample, get_conversations_by_id(conversation_ids[rater_own])], ignore_index=True) for rater_id, rater_own in zip(rater_ids, own)}
+
+	with TRACER.stage("sheet writes"), ThreadPoolExecutor(max_workers=min(sheet_client.MAX_WORKERS, len(rater_ids))) as pool:
+		writes = {rater_id: pool.submit(write_sample_to_sheet, samples[rater_id], rater_id) for rater_id in rater_ids}
+	# only log the allocations whose sheets were written
+	errors = []
+	for rater_id, write in writes.items():
+		if(write.exception() is not None):
+			errors.append(write.exception())
+			print("Could not update the rating sheet for " + str(rater_id) + ": " + str(write.exception()))
+			continue
+		update_log_allocated(samples[rater_id], rater_id)
+		print("Updated rating sheet for " + str(rater_id) + " with " + str(len(shared) + len(own[rater_ids.index(rater_id)])) + " new conversations (" + str(len(shared)) + " shared)!")
+	if(errors):
+		raise errors[0]
 
-Checks the cells pertaining to a user (rater_id) for their updated status and push changes to the log.
 """
-def update(rater_id):
+function: read_rater_sheet
 
-	# filter for id's that were allocated to the user
-	conversations_for_rater = LABEL_LOG[LABEL_LOG["rater_id"]==rater_id]
+Reads columns A-H of a rater's sheet, from start_row down, in a single API call (or from the sheet cache)
+and returns them as a DataFrame (one row per sheet row, with the sheet row number in `sheet_row`).
+"""
+def read_rater_sheet(rater_sheet, start_row=1, revision=None):
+	values = read_sheet_range(rater_sheet, "A{}:H".format(start_row), revision)
+	sheet_block = pd.DataFrame([row + [''] * (len(SHEET_COLUMNS) - len(row)) for row in values], columns=SHEET_COLUMNS)
+	sheet_block["sheet_row"] = np.arange(start_row, start_row + len(sheet_block))
+	return(sheet_block)
 
-	# additional filter for ONLY searching conversations that were previously not marked 'done'
-	# this can help speed things up a bit in terms of not searching through the entire history
-	# conversations_for_rater = LABEL_LOG[LABEL_LOG["status"]!="done"]
+"""
+function: apply_sheet_ratings
+
+Joins a block of sheet rows against the log entries of rater_id (by CONV_ID and id) and applies all
+rating/status changes in place with vectorized assignments. Returns the log index of the rows that changed.
+"""
+def apply_sheet_ratings(label_log, sheet_block, rater_id):
+	rater_index = label_log.index[label_log["rater_id"] == rater_id]
+	sheet_by_key = sheet_block.drop_duplicates(subset=["CONV_ID", "id"], keep="first").set_index(["CONV_ID", "id"])
+	rater_keys = pd.MultiIndex.from_frame(label_log.loc[rater_index, ["CONV_ID", "id"]].astype(str))
+	matched = sheet_by_key.reindex(rater_keys)[RATING_COLUMNS]
+	matched.index = rater_index
+	rated = matched.notna() & (matched != '')
+
+	before = label_log.loc[rater_index, RATING_COLUMNS + ["status"]].astype(str)
+	for col in RATING_COLUMNS:
+		label_log.loc[rated.index[rated[col]], col] = matched.loc[rated[col], col]
+	# if ratings are complete, mark status as "done"
+	label_log.loc[rated.index[rated.all(axis=1)], "status"] = "done"
+	after = label_log.loc[rater_index, RATING_COLUMNS + ["status"]].astype(str)
+
+	changed = rater_index[(after != before).any(axis=1).values]
+	label_log.loc[changed, "last_updated_time"] = str(pd.Timestamp.now())
+	return(changed)
 
-	message_ids = list(conversations_for_rater["id"])
+"""
+function: update
+
+Checks the cells pertaining to a user (rater_id) for their updated status and push changes to the log.
+
+Only sheet rows past the rater's watermark (the end of the fully rated prefix of the sheet) are read, and
+only blocks of rows whose contents changed since the last sync are diffed against the log. Pass full=True
+to ignore the stored sync state and re-check the rater's whole sheet. If the sheet's current revision is
+already known (e.g. from the watcher's change check), pass it as revision: it saves a metadata call, and is
+recorded in the sync state as the last revision synced.
+"""
+def update(rater_id, full=False, revision=None):
+	sync_state = load_sync_state()
+	rater_state = get_rater_state(sync_state, rater_id)
+	if(full):
+		rater_state["watermark"] = FIRST_DATA_ROW - 1
+		rater_state["block_hashes"] = {}
 
-	# check for id's in the spreadsheet
 	rater_sheet = RATING_DICTIONARY[rater_id]
-	sh = gc.open_by_url(rater_sheet).sheet1
-
-	for i, id_num in enumerate(message_ids):
-		cell = sh.find(id_num)
-		directness_content_cell = DIRECTNESS_CONTENT_COL + str(cell.row)
-		directness_expression_cell = DIRECTNESS_EXPRESSION_COL + str(cell.row)
-		oi_content_cell = OI_CONTENT_COL + str(cell.row)
-		oi_expression_cell = OI_EXPRESSION_COL + str(cell.row)
-
-		rating_directness_content = sh.acell(directness_content_cell).value
-		rating_directness_expression = sh.acell(directness_expression_cell).value
-		rating_OI_content = sh.acell(oi_content_cell).value
-		rating_OI_expression = sh.acell(oi_expression_cell).value
-		# check whether they were rated or not
-		if(rating_directness_content is not None):
-			LABEL_LOG.loc[(LABEL_LOG['id'] == id_num) & (LABEL_LOG['rater_id'] == rater_id), 'rating_directness_content'] = rating_directness_content
-			LABEL_LOG.loc[(LABEL_LOG['id'] == id_num) & (LABEL_LOG['rater_id'] == rater_id), 'last_updated_time'] = pd.Timestamp.now()
-		if(rating_directness_expression is not None):
-			LABEL_LOG.loc[(LABEL_LOG['id'] == id_num) & (LABEL_LOG['rater_id'] == rater_id), 'rating_directness_expression'] = rating_directness_expression
-			LABEL_LOG.loc[(LABEL_LOG['id'] == id_num) & (LABEL_LOG['rater_id'] == rater_id), 'last_updated_time'] = pd.Timestamp.now()
-		if(rating_OI_content is not None):
-			LABEL_LOG.loc[(LABEL_LOG['id'] == id_num) & (LABEL_LOG['rater_id'] == rater_id), 'rating_OI_content'] = rating_OI_content
-			LABEL_LOG.loc[(LABEL_LOG['id'] == id_num) & (LABEL_LOG['rater_id'] == rater_id), 'last_updated_time'] = pd.Timestamp.now()
-		if (rating_OI_expression is not None):
-			LABEL_LOG.loc[(LABEL_LOG['id'] == id_num) & (LABEL_LOG['rater_id'] == rater_id), 'rating_OI_expression'] = rating_OI_expression
-			LABEL_LOG.loc[(LABEL_LOG['id'] == id_num) & (LABEL_LOG['rater_id'] == rater_id), 'last_updated_time'] = pd.Timestamp.now()
-		# if ratings are complete, mark status as "done"
-		if(rating_directness_content is not None and rating_directness_expression is not None and rating_OI_content is not None and rating_OI_expression is not None):
-			LABEL_LOG.loc[(LABEL_LOG['id'] == id_num) & (LABEL_LOG['rater_id'] == rater_id), 'status'] = "done"
-			LABEL_LOG.loc[(LABEL_LOG['id'] == id_num) & (LABEL_LOG['rater_id'] == rater_id), 'last_updated_time'] = pd.Timestamp.now()
-
-		if(i > 0 and i % 10 == 0):
-			print(str(i) + " requests completed...")
-			if(i%20 == 0):
-				time.sleep(10) # sleeping due to API quota limits (for now)
-
-	# update LABEL_LOG
-	LABEL_LOG.to_csv(CONVERSATION_LABELING_LOG_PATH, index=False)
+	start_row = block_start_for_row(rater_state["watermark"] + 1)
+	with TRACER.stage("sheet read"):
+		sheet_block = read_rater_sheet(rater_sheet, start_row, revision)
+
+	# hash each block of rows, and only diff the blocks that changed since the last sync
+	block_hashes = {}
+	changed_blocks = []
+	with TRACER.stage("block hashing"):
+		for offset in range(0, len(sheet_block), BLOCK_SIZE):
+			block_start = str(start_row + offset)
+			block_hashes[block_start] = hash_block(sheet_block[SHEET_COLUMNS].iloc[offset:offset + BLOCK_SIZE].values.tolist())
+			if(rater_state["block_hashes"].get(block_start) != block_hashes[block_start]):
+				changed_blocks.append(sheet_block.iloc[offset:offset + BLOCK_SIZE])
+
+	changed = pd.Index([])
+	if(changed_blocks):
+		with TRACER.stage("log read"):
+			rater_log = LABEL_LOG.read(rater_id=rater_id)
+		with TRACER.stage("log merge"):
+			changed = apply_sheet_ratings(rater_log, pd.concat(changed_blocks), rater_id)
+	if(len(changed) > 0):
+		with TRACER.stage("log write"):
+			LABEL_LOG.upsert(rater_log.loc[changed])
+		with TRACER.stage("consensus"):
+			update_consensus(LABEL_LOG, rater_log.loc[changed])
+	print(str(len(changed)) + " log entries updated for " + str(rater_id) + " (" + str(len(changed_blocks)) + " of " + str(len(block_hashes)) + " sheet blocks changed).")
+
+	# advance the watermark past every fully rated row at the top of the block
+	complete = ((sheet_block["id"] != '') & (sheet_block[RATING_COLUMNS] != '').all(axis=1)).values
+	n_complete = len(complete) if complete.all() else int(np.argmin(complete))
+	rater_state["watermark"] = start_row - 1 + n_complete
+	first_kept_block = block_start_for_row(rater_state["watermark"] + 1)
+	rater_state["block_hashes"] = {block: h for block, h in block_hashes.items() if int(block) >= first_kept_block}
+	if(revision is not None):
+		rater_state["revision"] = revision
+	with TRACER.stage("sync state write"):
+		save_sync_state(sync_state, rater_id=rater_id)
 
 if __name__ == "__main__":
 
@@ -234,16 +327,38 @@ if __name__ == "__main__":
 	
 	# Using nargs to indicate that --schedule should take two arguments
 	parser.add_argument('--schedule', nargs=2, help='Add n_convos for rating to the spreadsheet belonging to rater_id. You need to pass in 2 arguments, rater_id and n_convos (in that order).')
+	parser.add_argument('--schedule-batch', nargs=1, help='Allocate conversations to several raters at once, following a JSON plan (see allocation_planner.py). You need to pass in 1 argument, the path to the plan.')
 	parser.add_argument('--update', nargs=1, help='Update the spreadsheet belonging to rater_id. You need to pass in 1 arguments, rater_id.')
+	parser.add_argument('--log-backend', choices=['csv', 'sqlite'], default=os.environ.get("CONFLICT_LOG_BACKEND", "csv"), help='Which labeling log backend to use (default: csv). The first run with sqlite migrates the existing CSV log.')
+	parser.add_argument('--export-log', nargs=1, help='Export the current labeling log (one row per entry) to the given CSV path.')
+	parser.add_argument('--offline', action='store_true', help='Used with --update: update the log purely from the last cached snapshot of the rater\'s sheet, without calling the Sheets API.')
+	parser.add_argument('--cache-ttl', type=float, default=sheet_client.SHEET_CACHE.ttl, help='Seconds for which a cached sheet snapshot is used without checking whether the sheet has changed (default: %(default)s).')
+	parser.add_argument('--consensus', action='store_true', help='Rebuild the consensus label table (see consensus.py) from the whole log. It is otherwise kept up to date by --update.')
+	parser.add_argument('--full', action='store_true', help='Used with --update: ignore the stored sync state and re-check every row of the rater\'s sheet.')
+	parser.add_argument('--trace', nargs='?', const='', help='Print a summary of where the run spent its time (every Sheets API call, and each local stage). If a path is given, every call and stage is also written to it as JSON lines.')
 	
 	args = parser.parse_args()
+	if args.trace is not None:
+		TRACER.enable(args.trace)
+	LABEL_LOG = open_label_log(args.log_backend)
+	sheet_client.SHEET_CACHE.offline = args.offline
+	sheet_client.SHEET_CACHE.ttl = args.cache_ttl
+	sheet_client.SHEET_CACHE.evict()
 
 	# Check if --schedule is provided
 	if args.schedule:
 		rater_id, n_convos = args.schedule
 		schedule(rater_id, int(n_convos))
+	elif args.schedule_batch:
+		schedule_batch(args.schedule_batch[0])
 	elif args.update:
 		rater_id = args.update[0]
-		update(rater_id)
+		update(rater_id, full=args.full)
+	elif args.export_log:
+		LABEL_LOG.export_csv(args.export_log[0])
+	elif args.consensus:
+		table = build_consensus(LABEL_LOG)
+		print("Consensus labels for " + str(len(table)) + " messages saved to " + CONSENSUS_PATH)
 	else:
 		print("No arguments provided. Usage: --schedule rater_id n_convos OR --update rater_id")
+	report()
@@ -0,0 +1,155 @@
+import os
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+from irr_conflict import METRICS, N_CATEGORIES, TEST_RATERS
+try:
+	import fcntl
+except ImportError: # not available on Windows
+	fcntl = None
+try:
+	import pyarrow
+except ImportError: # fall back to pickle if pyarrow is not installed
+	pyarrow = None
+
+"""
+The consensus label dataset: one row per message allocated to any rater, for downstream modeling.
+
+Each row is keyed by CONV_ID and id, and holds:
+- rating_[metric]_[rater_id]: the rater's label for the metric, as an integer category (using the conversion
+  dicts in irr_conflict.METRICS, so blank answers count as neutral, as in the IRR check); missing if the
+  rater has not finished rating the message (its log entry is not "done")
+- n_raters: the number of raters who have rated the message
+- [metric]_consensus: the label chosen by the most raters (missing if there is a tie, or no ratings)
+- [metric]_status: "unanimous", "majority", "tie", or "unrated"
+
+The table is kept up to date by the scheduler: after each --update, only the rows of the messages whose log
+entries changed are recomputed. It is saved as Parquet (CONSENSUS_PATH), or as a pickle if pyarrow is not
+installed, so that training jobs can read it without re-aggregating the log. Raters in
+irr_conflict.TEST_RATERS are left out.
+"""
+CONSENSUS_PATH = './CONFLICT_CONVO_CONSENSUS.parquet' if pyarrow is not None else './CONFLICT_CONVO_CONSENSUS.pkl'
+CONSENSUS_KEY = ["CONV_ID", "id"]
+
+# serializes the read-modify-write of the table across scheduler runs for different raters
+@contextmanager
+def _lock(path):
+	with open(path + ".lock", "w") as lock:
+		if(fcntl is not None):
+			fcntl.flock(lock, fcntl.LOCK_EX)
+		yield
+
+def rating_column(metric, rater_id):
+	return "rating_" + metric + "_" + rater_id
+
+def _rater_columns(table, metric):
+	return [col for col in table.columns if col.startswith("rating_" + metric + "_")]
+
+def load_consensus(path=CONSENSUS_PATH):
+	if(not os.path.isfile(path)):
+		return None
+	table = pd.read_parquet(path) if path.endswith(".parquet") else pd.read_pickle(path)
+	return table.set_index(CONSENSUS_KEY)
+
+def _save(table, path):
+	table = table.reset_index()
+	rater_columns = sorted(col for col in table.columns if col.startswith("rating_"))
+	summary_columns = [col for metric in METRICS for col in [metric + "_consensus", metric + "_status"]]
+	table = table[CONSENSUS_KEY + ["n_raters"] + summary_columns + rater_columns].astype({"n_raters": "Int64", **{col: "Int8" for col in table.columns if col.startswith("rating_") or col.endswith("_consensus")}})
+	# write to a temporary file first, so an interrupted run never leaves a truncated table
+	tmp_path = path + ".tmp"
+	if(path.endswith(".parquet")):
+		table.to_parquet(tmp_path, index=False)
+	else:
+		table.to_pickle(tmp_path)
+	os.replace(tmp_path, path)
+	return table.set_index(CONSENSUS_KEY)
+
+"""
+function: encode_entries
+
+Converts log entries to integer labels, one column per metric (missing unless the entry is "done").
+Answers that are not in a metric's conversion dict are also left missing.
+"""
+def encode_entries(entries):
+	entries = entries[~entries["rater_id"].isin(TEST_RATERS)]
+	done = (entries["status"] == "done").values
+	encoded = pd.DataFrame({"CONV_ID": entries["CONV_ID"].astype(str).values, "id": entries["id"].astype(str).values, "rater_id": entries["rater_id"].values})
+	for metric, spec in METRICS.items():
+		codes = entries["rating_" + metric].fillna('').astype(str).map(spec["conversion"]).astype("Int8")
+		encoded[metric] = codes.where(done, pd.NA).values
+	return encoded
+
+"""
+function: summarize_rows
+
+Computes n_raters, and each metric's consensus label and status, for the given rows of the table (in place).
+"""
+def summarize_rows(table, rows):
+	n_raters = None
+	for metric in METRICS:
+		labels = table.loc[rows, _rater_columns(table, metric)].astype("Int8").to_numpy(dtype=np.int64, na_value=-1)
+		counts = (labels[:, :, np.newaxis] == np.arange(N_CATEGORIES)).sum(axis=1)
+		top = counts.max(axis=1)
+		tied = (counts == top[:, np.newaxis]).sum(axis=1) > 1
+		rated = (labels >= 0).sum(axis=1)
+		n_raters = rated if n_raters is None else np.maximum(n_raters, rated)
+
+		table.loc[rows, metric + "_consensus"] = pd.Series(counts.argmax(axis=1), dtype="Int8").where((top > 0) & ~tied).values
+		table.loc[rows, metric + "_status"] = np.select([top == 0, tied, top == rated], ["unrated", "tie", "unanimous"], "majority")
+	table.loc[rows, "n_raters"] = n_raters
+
+"""
+function: apply_entries
+
+Writes the labels of the given log entries into the table (adding rows and rater columns as needed), and
+recomputes the summary columns of the affected rows only. Returns the updated table.
+"""
+def apply_entries(table, entries):
+	encoded = encode_entries(entries)
+	if(encoded.empty):
+		return table
+	keys = pd.MultiIndex.from_frame(encoded[CONSENSUS_KEY])
+	new_keys = keys.unique().difference(table.index)
+	if(len(new_keys) > 0):
+		table = pd.concat([table, pd.DataFrame(index=new_keys, columns=table.columns)])
+	for rater_id, rater_entries in encoded.groupby("rater_id"):
+		rater_keys = pd.MultiIndex.from_frame(rater_entries[CONSENSUS_KEY])
+		for metric in METRICS:
+			col = rating_column(metric, rater_id)
+			if(col not in table):
+				table[col] = pd.array([pd.NA] * len(table), dtype="Int8")
+			table.loc[rater_keys, col] = rater_entries[metric].values
+	summarize_rows(table, keys.unique())
+	return table
+
+def empty_consensus():
+	return pd.DataFrame(
+		{"n_raters": pd.array([], dtype="Int64"), **{col: pd.array([], dtype="Int8" if col.endswith("_consensus") else object) for metric in METRICS for col in [metric + "_consensus", metric + "_status"]}},
+		index=pd.MultiIndex.from_arrays([[], []], names=CONSENSUS_KEY)
+	)
+
+"""
+function: build_consensus
+
+Rebuilds the whole table from every entry in label_log, and saves it.
+"""
+def build_consensus(label_log, path=CONSENSUS_PATH):
+	with _lock(path):
+		table = apply_entries(empty_consensus(), label_log.read())
+		table = _save(table, path)
+	return table
+
+"""
+function: update_consensus
+
+Recomputes the rows of the messages in changed_entries (log entries that were just written to label_log),
+and saves the table. If there is no table yet, it is built from the whole log instead.
+"""
+def update_consensus(label_log, changed_entries, path=CONSENSUS_PATH):
+	with _lock(path):
+		table = load_consensus(path)
+		table = apply_entries(empty_consensus() if table is None else table, label_log.read() if table is None else changed_entries)
+		table = _save(table, path)
+	return table
+
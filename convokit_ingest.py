@@ -0,0 +1,289 @@
+import argparse
+import json
+import os
+import random
+import re
+import pandas as pd
+
+"""
+Streaming ingestion of the ConvoKit corpora into the CSVs that the scheduler allocates from (this replaces
+running conflict_reddit_data/convokit_data_downloader.ipynb by hand).
+
+Each corpus is read from a local ConvoKit corpus directory (e.g. the one that convokit's download() saves to),
+one line of its utterances.jsonl at a time, and handled one conversation at a time:
+- awry ("conversations-gone-awry-cmv-corpus"): each conversation is one thread, with CONV_ID = conversation_id
+- winning ("winning-args-corpus"): every pair p_i in a conversation becomes two threads, "i_A" (the
+  unsuccessful arguments, meta.success == 0) and "i_B" (the successful ones), each starting with the original
+  post (whose reply_to is set to "ORIGINAL_POST")
+Within each thread, carriage returns are replaced with newlines, long messages are split into
+"{id}_1", "{id}_2", ... (see split_long_message), conversation_length is set to the thread's number of
+messages, and '[deleted]' messages are dropped, exactly as in the notebook.
+
+The threads are written out in chunks of CHUNK_ROWS rows (to CSV, or to Parquet row groups), and a sample of
+conversations is drawn with reservoir sampling as they stream past, so memory use depends only on the size of
+a single conversation, the chunk, and the sample, never on the size of the corpus.
+"""
+OUTPUT_COLUMNS = ["CONV_ID", "text", "speaker", "id", "timestamp", "meta.score", "reply_to", "conversation_length"]
+INTEGER_COLUMNS = ["timestamp", "meta.score", "conversation_length"]
+
+FULL_DATA_DIR = './conflict_reddit_data/full_data'
+SAMPLES_DIR = './conflict_reddit_data/samples'
+OUTPUT_NAMES = {
+	"awry": ("conversations_gone_awry", "awry_samples"),
+	"winning": ("winning_conversations", "winning_samples")
+}
+
+SPLIT_THRESHOLD = 50
+CHUNK_ROWS = 10000
+N_SAMPLE_CONVERSATIONS = 100
+SAMPLE_SEED = 19104
+
+"""
+function: read_utterances
+
+Yields the utterances of a ConvoKit corpus directory, one at a time.
+"""
+def read_utterances(corpus_dir):
+	with open(os.path.join(corpus_dir, "utterances.jsonl")) as f:
+		for line in f:
+			if(line.strip()):
+				yield json.loads(line)
+
+"""
+function: group_conversations
+
+Groups a stream of utterances into (conversation_id, utterances) pairs. ConvoKit writes the utterances of each
+conversation together, which is what lets the corpus be streamed; a ValueError is raised if it did not.
+"""
+def group_conversations(utterances):
+	finished = set()
+	conversation_id, conversation = None, []
+	for utterance in utterances:
+		if(utterance["conversation_id"] != conversation_id):
+			if(conversation):
+				finished.add(conversation_id)
+				yield conversation_id, conversation
+			conversation_id, conversation = utterance["conversation_id"], []
+			if(conversation_id in finished):
+				raise ValueError('The utterances of conversation ' + str(conversation_id) + ' are not stored together, so the corpus cannot be streamed.')
+		conversation.append(utterance)
+	if(conversation):
+		yield conversation_id, conversation
+
+def message_row(utterance, conv_id, reply_to=None):
+	return {
+		"CONV_ID": conv_id,
+		# Replace the carriage return ('\r') with the regular new line character ('\n')
+		"text": utterance["text"].replace('\r', '\n'),
+		"speaker": utterance.get("speaker", utterance.get("user")),
+		"id": utterance["id"],
+		"timestamp": utterance.get("timestamp"),
+		"meta.score": (utterance.get("meta") or {}).get("score"),
+		"reply_to": utterance.get("reply_to") if reply_to is None else reply_to
+	}
+
+"""
+function: awry_threads
+
+Yields the rows of each thread of the conversations-gone-awry corpus (one per conversation).
+"""
+def awry_threads(conversations):
+	for conversation_id, utterances in conversations:
+		yield [message_row(utterance, conversation_id) for utterance in utterances]
+
+"""
+function: winning_threads
+
+Yields the rows of each thread of the winning-args corpus: the original post, followed by either the
+unsuccessful ("_A") or the successful ("_B") arguments of one pair.
+"""
+def winning_threads(conversations):
+	for conversation_id, utterances in conversations:
+		op = [utterance for utterance in utterances if utterance["id"] == conversation_id]
+		pair_ids = sorted({pair_id for utterance in utterances for pair_id in utterance["meta"].get("pair_ids") or []}, key=lambda pair_id: int(pair_id[len("p_"):]))
+		for pair_id in pair_ids:
+			for success, suffix in [(0, "_A"), (1, "_B")]:
+				conv_id = pair_id[len("p_"):] + suffix
+				thread = [utterance for utterance in utterances if pair_id in (utterance["meta"].get("pair_ids") or []) and utterance["meta"].get("success") == success]
+				yield [message_row(utterance, conv_id, reply_to="ORIGINAL_POST") for utterance in op] + [message_row(utterance, conv_id) for utterance in thread]
+
+"""
+function: split_long_message
+
+Splits a message of more than `threshold` words (that isn't an original post, and has newlines to split on)
+into several messages of at least `threshold` words each, keeping quotes ('&gt;') together with the response
+that follows them. Returns the list of resulting rows.
+"""
+def split_long_message(row, threshold=SPLIT_THRESHOLD):
+	text = row['text']
+	message_id = row['id']
+	if(not (len(text.split()) > threshold and '\n' in text and row['reply_to'] != "ORIGINAL_POST")):
+		return [row] # No changes necessary
+
+	new_rows = []
+	def add_chunk(chunk_text):
+		new_row = dict(row)
+		new_row['text'] = chunk_text.strip()
+		new_row['id'] = f"{message_id}_{len(new_rows) + 1}"
+		new_rows.append(new_row)
+
+	chunks = [chunk.strip() for chunk in text.split('\n') if chunk.strip()]
+	current_chunk = ""
+	gt = False
+	for chunk in chunks:
+		current_chunk += chunk
+		# a chunk containing '&gt;' quotes another person: keep it with the response that follows
+		if("&gt;" in chunk):
+			current_chunk += "\n"
+			gt = True
+		elif(gt): # We found the response to the quote, so save it.
+			add_chunk(current_chunk)
+			current_chunk = ""
+			gt = False
+		elif(len(re.sub('\n', '', current_chunk).split()) > threshold): # chunk is long enough; save directly
+			add_chunk(current_chunk)
+			current_chunk = ""
+		else: # not long enough; add next chunk
+			current_chunk += "\n"
+	if(current_chunk != ""):
+		# add the last chunk, if it wasn't long enough
+		add_chunk(current_chunk)
+	return new_rows
+
+"""
+function: process_thread
+
+Splits the long messages of a thread, adds conversation_length, and drops '[deleted]' messages.
+"""
+def process_thread(rows, threshold=SPLIT_THRESHOLD):
+	rows = [new_row for row in rows for new_row in split_long_message(row, threshold)]
+	for row in rows:
+		row["conversation_length"] = len(rows)
+	return [row for row in rows if row["text"] != '[deleted]']
+
+def rows_to_frame(rows):
+	frame = pd.DataFrame(rows, columns=OUTPUT_COLUMNS)
+	return frame.astype({col: "Int64" for col in INTEGER_COLUMNS})
+
+"""
+class: ChunkedWriter
+
+Buffers rows and writes them out CHUNK_ROWS at a time, to a CSV file or (for a path ending in .parquet) as row
+groups of a Parquet file. The output is written to a temporary file and only moved into place by close().
+"""
+class ChunkedWriter:
+	def __init__(self, path, chunk_rows=CHUNK_ROWS):
+		self.path = path
+		self.tmp_path = path + ".tmp"
+		self.chunk_rows = chunk_rows
+		self.parquet = path.endswith(".parquet")
+		self.parquet_writer = None
+		self.rows = []
+		self.n_written = 0
+
+	def write(self, rows):
+		self.rows.extend(rows)
+		if(len(self.rows) >= self.chunk_rows):
+			self.flush()
+
+	def flush(self):
+		if(not self.rows and self.n_written > 0):
+			return
+		chunk = rows_to_frame(self.rows)
+		if(self.parquet):
+			import pyarrow as pa
+			import pyarrow.parquet as pq
+			table = pa.Table.from_pandas(chunk, preserve_index=False)
+			if(self.parquet_writer is None):
+				self.schema = pa.schema([pa.field(col, pa.int64() if col in INTEGER_COLUMNS else pa.string()) for col in OUTPUT_COLUMNS])
+				self.parquet_writer = pq.ParquetWriter(self.tmp_path, self.schema)
+			self.parquet_writer.write_table(table.cast(self.schema))
+		else:
+			chunk.to_csv(self.tmp_path, mode='w' if self.n_written == 0 else 'a', header=self.n_written == 0, index=False)
+		self.n_written += len(self.rows)
+		self.rows = []
+
+	def close(self):
+		if(self.rows or self.n_written == 0):
+			self.flush()
+		if(self.parquet_writer is not None):
+			self.parquet_writer.close()
+		os.replace(self.tmp_path, self.path)
+
+"""
+class: ConversationReservoir
+
+A uniform random sample of `size` conversations from a stream of conversations (reservoir sampling), seeded
+so that the same corpus always gives the same sample.
+"""
+class ConversationReservoir:
+	def __init__(self, size=N_SAMPLE_CONVERSATIONS, seed=SAMPLE_SEED):
+		self.size = size
+		self.random = random.Random(seed)
+		self.sample = []
+		self.n_seen = 0
+
+	def add(self, rows):
+		self.n_seen += 1
+		if(len(self.sample) < self.size):
+			self.sample.append(rows)
+		else:
+			replace = self.random.randrange(self.n_seen)
+			if(replace < self.size):
+				self.sample[replace] = rows
+
+	def rows(self):
+		return [row for rows in self.sample for row in rows]
+
+"""
+function: ingest_corpus
+
+Streams one corpus (kind is "awry" or "winning") from corpus_dir into output_path, and saves a sample of
+sample_size conversations to sample_path. Returns the number of conversations and messages written.
+"""
+def ingest_corpus(corpus_dir, kind, output_path, sample_path, sample_size=N_SAMPLE_CONVERSATIONS, seed=SAMPLE_SEED, threshold=SPLIT_THRESHOLD, chunk_rows=CHUNK_ROWS):
+	conversations = group_conversations(read_utterances(corpus_dir))
+	threads = awry_threads(conversations) if kind == "awry" else winning_threads(conversations)
+
+	writer = ChunkedWriter(output_path, chunk_rows)
+	reservoir = ConversationReservoir(sample_size, seed)
+	n_messages = 0
+	for thread in threads:
+		rows = process_thread(thread, threshold)
+		if(not rows):
+			continue
+		writer.write(rows)
+		reservoir.add(rows)
+		n_messages += len(rows)
+	writer.close()
+	rows_to_frame(reservoir.rows()).to_csv(sample_path, index=False)
+	return reservoir.n_seen, n_messages
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description='Streams the ConvoKit conflict corpora into the CSVs used by the conflict rating scheduler, and draws the conversation samples.')
+	parser.add_argument('--awry', help='Path to the local conversations-gone-awry-cmv-corpus directory.')
+	parser.add_argument('--winning', help='Path to the local winning-args-corpus directory.')
+	parser.add_argument('--output-dir', default=FULL_DATA_DIR, help='Where to write the full data (default: %(default)s).')
+	parser.add_argument('--samples-dir', default=SAMPLES_DIR, help='Where to write the samples (default: %(default)s).')
+	parser.add_argument('--format', choices=['csv', 'parquet'], default='csv', help='Format of the full data (default: csv, which is what the scheduler reads).')
+	parser.add_argument('--sample-size', type=int, default=N_SAMPLE_CONVERSATIONS, help='Number of conversations to sample from each corpus (default: %(default)s).')
+	parser.add_argument('--seed', type=int, default=SAMPLE_SEED, help='Seed for the samples (default: %(default)s).')
+	parser.add_argument('--threshold', type=int, default=SPLIT_THRESHOLD, help='Messages longer than this many words are split (default: %(default)s).')
+	parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help='Number of rows written at a time (default: %(default)s).')
+	args = parser.parse_args()
+
+	corpora = {kind: corpus_dir for kind, corpus_dir in [("awry", args.awry), ("winning", args.winning)] if corpus_dir}
+	if(not corpora):
+		print("No corpora provided. Usage: --awry corpus_dir AND/OR --winning corpus_dir")
+	os.makedirs(args.output_dir, exist_ok=True)
+	os.makedirs(args.samples_dir, exist_ok=True)
+	for kind, corpus_dir in corpora.items():
+		output_name, sample_name = OUTPUT_NAMES[kind]
+		n_conversations, n_messages = ingest_corpus(
+			corpus_dir, kind,
+			os.path.join(args.output_dir, output_name + "." + args.format),
+			os.path.join(args.samples_dir, sample_name + ".csv"),
+			sample_size=args.sample_size, seed=args.seed, threshold=args.threshold, chunk_rows=args.chunk_rows
+		)
+		print(kind + ": " + str(n_conversations) + " total conversations, " + str(n_messages) + " messages")
@@ -0,0 +1,156 @@
+import json
+import os
+import random
+import tempfile
+import numpy as np
+import pandas as pd
+try:
+	import pyarrow.feather as feather
+except ImportError: # fall back to pickle if pyarrow is not installed
+	feather = None
+
+"""
+Lazy access to the conversation corpus that the scheduler allocates from.
+
+The corpus is the ConvoKit exports in CORPUS_PATHS. The first time it is needed, it is converted (once) to a
+columnar cache holding only the columns the scheduler uses, with the rows grouped by conversation:
+- conversations.feather (or conversations.pkl without pyarrow): CONV_ID, id, speaker, text, conversation_length,
+  with CONV_ID and speaker stored as categoricals
+- index.npz: for each CONV_ID, its [start, stop) row range, and the constant, but random, shuffled order of
+  CONV_IDs that conversations are allocated in
+The cache is rebuilt whenever one of the source CSVs changes. Nothing is read at import time; only the
+rows of the conversations actually being allocated are materialized (the Feather file is memory-mapped).
+"""
+CORPUS_PATHS = [
+	'./conflict_reddit_data/full_data/conversations_gone_awry.csv',
+	'./conflict_reddit_data/full_data/winning_conversations.csv'
+]
+CORPUS_CACHE_DIR = './conflict_reddit_data/full_data/.corpus_cache'
+CORPUS_COLUMNS = ["CONV_ID", "id", "speaker", "text", "conversation_length"]
+SHUFFLE_SEED = 19104
+
+_index = None
+
+def _source_signature():
+	return [[path, os.path.getsize(path), os.path.getmtime(path)] for path in CORPUS_PATHS]
+
+def _data_path():
+	return os.path.join(CORPUS_CACHE_DIR, "conversations.feather" if feather is not None else "conversations.pkl")
+
+def _manifest_path():
+	return os.path.join(CORPUS_CACHE_DIR, "manifest.json")
+
+def _index_path():
+	return os.path.join(CORPUS_CACHE_DIR, "index.npz")
+
+def _cache_is_fresh():
+	if(not os.path.isfile(_manifest_path()) or not os.path.isfile(_data_path()) or not os.path.isfile(_index_path())):
+		return False
+	with open(_manifest_path()) as f:
+		return json.load(f)["sources"] == _source_signature()
+
+"""
+function: _write_atomically
+
+Calls write(tmp_path) on a temporary file of its own next to path, then moves it into place, so that
+scheduler runs building the cache at the same time never read (or replace) each other's half-written files.
+"""
+def _write_atomically(path, write):
+	fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp" + os.path.splitext(path)[1])
+	os.close(fd)
+	try:
+		write(tmp_path)
+		os.replace(tmp_path, path)
+	except BaseException:
+		os.remove(tmp_path)
+		raise
+
+"""
+function: build_corpus_cache
+
+Converts the source CSVs to the columnar cache and builds the CONV_ID index and shuffled order.
+"""
+def build_corpus_cache():
+	frames = [pd.read_csv(path, usecols=lambda col: col in CORPUS_COLUMNS, dtype={"CONV_ID": str, "id": str, "speaker": str, "text": str}) for path in CORPUS_PATHS]
+	conversations = pd.concat(frames, ignore_index=True)
+
+	# group the rows by conversation (keeping the corpus order, which already lists each conversation's messages together)
+	codes, conv_ids = pd.factorize(conversations["CONV_ID"])
+	conversations = conversations.iloc[np.argsort(codes, kind="stable")].reset_index(drop=True)
+	lengths = np.bincount(codes, minlength=len(conv_ids))
+	stops = np.cumsum(lengths)
+	starts = stops - lengths
+	if("conversation_length" not in conversations):
+		conversations["conversation_length"] = np.repeat(lengths, lengths)
+	conversations["CONV_ID"] = pd.Categorical(conversations["CONV_ID"], categories=conv_ids)
+	conversations["speaker"] = conversations["speaker"].astype("category")
+	conversations = conversations[CORPUS_COLUMNS]
+
+	# Define a constant, but random, ordering for the conversations
+	shuffled = sorted(set(conv_ids))
+	random.Random(SHUFFLE_SEED).shuffle(shuffled)
+
+	os.makedirs(CORPUS_CACHE_DIR, exist_ok=True)
+	if(feather is not None):
+		_write_atomically(_data_path(), conversations.to_feather)
+	else:
+		_write_atomically(_data_path(), conversations.to_pickle)
+	_write_atomically(_index_path(), lambda path: np.savez(path, conv_ids=np.array(conv_ids, dtype=str), starts=starts, stops=stops, shuffled=np.array(shuffled, dtype=str)))
+	def write_manifest(path):
+		with open(path, "w") as f:
+			json.dump({"sources": _source_signature()}, f)
+	# the manifest goes last, so the cache is only ever seen as fresh once all of its files are in place
+	_write_atomically(_manifest_path(), write_manifest)
+
+"""
+function: get_conversation_index
+
+Returns the CONV_ID index (building the cache first if needed): a dict with `conv_ids`, their row ranges
+`starts`/`stops`, and the `shuffled` allocation order of CONV_IDs.
+"""
+def get_conversation_index():
+	global _index
+	if(_index is None):
+		if(not _cache_is_fresh()):
+			build_corpus_cache()
+		with np.load(_index_path()) as index:
+			_index = {key: index[key] for key in index.files}
+		_index["positions"] = pd.Index(_index["conv_ids"])
+	return _index
+
+"""
+function: get_conversation_ids
+
+Returns the CONV_IDs in the constant, but random, order in which they are allocated.
+"""
+def get_conversation_ids():
+	return list(get_conversation_index()["shuffled"])
+
+"""
+function: get_conversation_lengths
+
+Returns the number of messages in each conversation, in the same order as get_conversation_ids().
+"""
+def get_conversation_lengths():
+	index = get_conversation_index()
+	positions = index["positions"].get_indexer(index["shuffled"])
+	return index["stops"][positions] - index["starts"][positions]
+
+"""
+function: get_conversations_by_id
+
+Returns the messages of the given conversations (in corpus order), reading only their rows.
+"""
+def get_conversations_by_id(conv_ids):
+	index = get_conversation_index()
+	positions = index["positions"].get_indexer(list(conv_ids))
+	positions = np.sort(positions[positions >= 0])
+	lengths = index["stops"][positions] - index["starts"][positions]
+	# expand each [start, stop) range into its row numbers
+	rows = np.repeat(index["starts"][positions] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+	if(feather is not None):
+		conversations = feather.read_table(_data_path(), memory_map=True).take(rows).to_pandas()
+	else:
+		conversations = pd.read_pickle(_data_path()).iloc[rows].reset_index(drop=True)
+	# the sample is small, so hand it back with plain (rather than categorical) columns
+	return conversations.astype({"CONV_ID": str, "speaker": str})
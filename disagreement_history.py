@@ -0,0 +1,259 @@
+import argparse
+import json
+import os
+import re
+import numpy as np
+import pandas as pd
+from irr_conflict import METRICS
+
+"""
+A compact, versioned history of the messages that raters disagreed on, replacing dated copies of the
+files in disagreed_messages/ (e.g. OI_content_2-16-24.csv).
+
+Each round of the IRR check (one set of disagreement files, as written by irr_conflict.get_disagreed_messages)
+is a set of (id, metric, rater, label) facts. The history stores them in HISTORY_DIR as:
+- messages.csv: the text of each message, once per id
+- vocab.json: the rounds (in order), and the raters and labels that the facts' integer codes refer to
+- facts.npz: one integer column per field (message, metric, rater, label), plus the first round a fact was
+  seen in and the round it stopped being seen in (OPEN while it still is)
+
+A fact that stays the same across rounds is stored once, so the history grows with the changes between
+rounds, not with the number of rounds. The facts at any round, and the difference between any two rounds
+(which disagreements were resolved, introduced, or changed), are computed with array operations over the
+fact columns. A round that only covers some metrics (e.g. from irr_conflict.py --check) leaves the facts of
+the other metrics as they were.
+"""
+HISTORY_DIR = './disagreed_messages/history'
+OPEN = np.iinfo(np.int32).max
+FACT_COLUMNS = ["message", "metric", "rater", "label", "start", "end"]
+FACT_DTYPES = {"message": np.int32, "metric": np.int8, "rater": np.int16, "label": np.int16, "start": np.int32, "end": np.int32}
+
+# the dated copies written by explore_disagreements.ipynb, e.g. OI_content_2-16-24.csv
+SNAPSHOT_NAME = re.compile(r"^(?P<metric>.+)_(?P<month>\d{1,2})-(?P<day>\d{1,2})-(?P<year>\d{2})\.csv$")
+
+class DisagreementHistory:
+	def __init__(self, path=HISTORY_DIR):
+		self.path = path
+		self.vocab = {"rounds": [], "metrics": list(METRICS), "raters": [], "labels": [], "n_messages": 0}
+		self.facts = {col: np.empty(0, dtype=dtype) for col, dtype in FACT_DTYPES.items()}
+		self.messages = pd.DataFrame({"id": pd.Series([], dtype=str), "text": pd.Series([], dtype=str)})
+		if(os.path.isfile(self._vocab_path())):
+			with open(self._vocab_path()) as f:
+				self.vocab = json.load(f)
+			with np.load(self._facts_path()) as facts:
+				self.facts = {col: facts[col] for col in FACT_COLUMNS}
+			# messages.csv is appended to before vocab.json is saved, so ignore rows from an interrupted save
+			self.messages = pd.read_csv(self._messages_path(), dtype=str, keep_default_na=False).iloc[:self.vocab["n_messages"]]
+		self.message_codes = pd.Index(self.messages["id"])
+
+	def _vocab_path(self):
+		return os.path.join(self.path, "vocab.json")
+
+	def _facts_path(self):
+		return os.path.join(self.path, "facts.npz")
+
+	def _messages_path(self):
+		return os.path.join(self.path, "messages.csv")
+
+	@property
+	def rounds(self):
+		return [round_info["name"] for round_info in self.vocab["rounds"]]
+
+	def _round_index(self, name):
+		if(name not in self.rounds):
+			raise ValueError('No round named ' + str(name) + ' in the disagreement history. Rounds: ' + ", ".join(self.rounds))
+		return self.rounds.index(name)
+
+	def _codes(self, vocab_key, values):
+		# codes of values in vocab[vocab_key], adding the values that are new
+		vocab = self.vocab[vocab_key]
+		for value in pd.unique(values):
+			if(value not in vocab):
+				vocab.append(value)
+		return pd.Index(vocab).get_indexer(values)
+
+	"""
+	function: encode_round
+
+	Converts a round's disagreement files ({metric: DataFrame with id, text, rating_[metric], rater_id}) to
+	arrays of fact codes, adding new messages, raters, and labels to the vocabularies.
+	"""
+	def encode_round(self, disagreements):
+		frames = []
+		for metric, frame in disagreements.items():
+			frames.append(pd.DataFrame({
+				"id": frame["id"].astype(str).values,
+				"text": frame["text"].fillna('').astype(str).values,
+				"metric": self.vocab["metrics"].index(metric),
+				"rater_id": frame["rater_id"].astype(str).values,
+				"label": frame["rating_" + metric].fillna('').astype(str).values
+			}))
+		facts = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=["id", "text", "metric", "rater_id", "label"])
+
+		new_messages = facts.drop_duplicates("id")
+		new_messages = new_messages[self.message_codes.get_indexer(new_messages["id"]) < 0][["id", "text"]]
+		self.messages = pd.concat([self.messages, new_messages], ignore_index=True)
+		self.message_codes = pd.Index(self.messages["id"])
+
+		codes = pd.DataFrame({
+			"message": self.message_codes.get_indexer(facts["id"]),
+			"metric": facts["metric"].astype(int).values,
+			"rater": self._codes("raters", facts["rater_id"].values),
+			"label": self._codes("labels", facts["label"].values)
+		}).drop_duplicates()
+		return new_messages, {col: codes[col].to_numpy(dtype=FACT_DTYPES[col]) for col in codes}
+
+	"""
+	function: record_round
+
+	Adds a round to the history: facts that are no longer seen (for the metrics in the round) are closed,
+	and facts that are new are added. Returns the number of facts (closed, added).
+	"""
+	def record_round(self, name, disagreements, recorded_at=None):
+		if(name in self.rounds):
+			raise ValueError('The disagreement history already has a round named ' + str(name) + '.')
+		round_index = len(self.vocab["rounds"])
+		new_messages, codes = self.encode_round(disagreements)
+		metrics = [self.vocab["metrics"].index(metric) for metric in disagreements]
+
+		current = (self.facts["end"] == OPEN) & np.isin(self.facts["metric"], metrics)
+		seen = np.isin(self._keys(self.facts), self._keys(codes))
+		closed = current & ~seen
+		self.facts["end"][closed] = round_index
+
+		added = ~np.isin(self._keys(codes), self._keys(self.facts)[self.facts["end"] == OPEN])
+		for col in FACT_COLUMNS:
+			new_values = codes[col][added] if col in codes else np.full(added.sum(), round_index if col == "start" else OPEN)
+			self.facts[col] = np.concatenate([self.facts[col], new_values.astype(FACT_DTYPES[col])])
+
+		self.vocab["rounds"].append({"name": name, "recorded_at": recorded_at or str(pd.Timestamp.now()), "metrics": [self.vocab["metrics"][metric] for metric in metrics]})
+		self._save(new_messages)
+		return int(closed.sum()), int(added.sum())
+
+	def _keys(self, facts):
+		# one int64 per (message, metric, rater, label)
+		return (facts["message"].astype(np.int64) << 32) | (facts["metric"].astype(np.int64) << 24) | (facts["rater"].astype(np.int64) << 12) | facts["label"].astype(np.int64)
+
+	def _save(self, new_messages):
+		os.makedirs(self.path, exist_ok=True)
+		if(not os.path.isfile(self._messages_path())):
+			pd.DataFrame(columns=["id", "text"]).to_csv(self._messages_path(), index=False)
+		# keep only the rows that were fully saved (in case a previous save was interrupted), then append the new messages
+		if(len(pd.read_csv(self._messages_path(), dtype=str, usecols=["id"])) != self.vocab["n_messages"]):
+			self.messages.iloc[:self.vocab["n_messages"]].to_csv(self._messages_path(), index=False)
+		new_messages.to_csv(self._messages_path(), mode="a", header=False, index=False)
+		self.vocab["n_messages"] = len(self.messages)
+
+		# write to temporary files first, so an interrupted save never leaves a truncated history
+		with open(self._facts_path() + ".tmp", "wb") as f:
+			np.savez_compressed(f, **self.facts)
+		with open(self._vocab_path() + ".tmp", "w") as f:
+			json.dump(self.vocab, f, indent=1)
+		os.replace(self._facts_path() + ".tmp", self._facts_path())
+		os.replace(self._vocab_path() + ".tmp", self._vocab_path())
+
+	def _alive(self, round_index):
+		return (self.facts["start"] <= round_index) & (round_index < self.facts["end"])
+
+	def _decode(self, mask):
+		return pd.DataFrame({
+			"id": self.messages["id"].values[self.facts["message"][mask]],
+			"metric": np.array(self.vocab["metrics"], dtype=object)[self.facts["metric"][mask]],
+			"rater_id": np.array(self.vocab["raters"], dtype=object)[self.facts["rater"][mask]],
+			"label": np.array(self.vocab["labels"], dtype=object)[self.facts["label"][mask]]
+		})
+
+	"""
+	function: snapshot
+
+	Returns the disagreements at a round, for one metric, in the format of the disagreement files
+	(id, text, rating_[metric], rater_id).
+	"""
+	def snapshot(self, name, metric):
+		mask = self._alive(self._round_index(name)) & (self.facts["metric"] == self.vocab["metrics"].index(metric))
+		facts = self._decode(mask)
+		return pd.DataFrame({
+			"id": facts["id"],
+			"text": self.messages["text"].values[self.facts["message"][mask]],
+			"rating_" + metric: facts["label"],
+			"rater_id": facts["rater_id"]
+		})
+
+	"""
+	function: diff
+
+	Compares two rounds. Returns one row per (message, metric, rater) that was disagreed on in either round,
+	with the rater's label in each (label_a, label_b; missing if the message was not disagreed on), and the
+	change of the message for that metric: "resolved", "introduced", "changed" (disagreed on in both, with
+	different labels), or "unchanged" (only if include_unchanged). Restrict it to one metric with metric.
+	"""
+	def diff(self, round_a, round_b, metric=None, include_unchanged=False):
+		alive_a, alive_b = self._alive(self._round_index(round_a)), self._alive(self._round_index(round_b))
+		mask = alive_a | alive_b
+		if(metric is not None):
+			mask &= self.facts["metric"] == self.vocab["metrics"].index(metric)
+		facts = self._decode(mask)
+		facts["in_a"], facts["in_b"] = alive_a[mask], alive_b[mask]
+		facts["label_a"] = facts["label"].where(facts["in_a"])
+		facts["label_b"] = facts["label"].where(facts["in_b"])
+
+		rows = facts.groupby(["id", "metric", "rater_id"], sort=False).agg(label_a=("label_a", "first"), label_b=("label_b", "first"), in_a=("in_a", "any"), in_b=("in_b", "any")).reset_index()
+		rows["differs"] = rows["label_a"].fillna("\0") != rows["label_b"].fillna("\0")
+		pairs = rows.groupby(["id", "metric"], sort=False)
+		in_a, in_b, differs = pairs["in_a"].transform("any"), pairs["in_b"].transform("any"), pairs["differs"].transform("any")
+		rows["change"] = np.select([in_a & ~in_b, ~in_a & in_b, differs], ["resolved", "introduced", "changed"], "unchanged")
+		if(not include_unchanged):
+			rows = rows[rows["change"] != "unchanged"]
+		rows = rows.merge(self.messages, on="id", how="left")
+		return rows[["id", "text", "metric", "rater_id", "label_a", "label_b", "change"]].sort_values(["metric", "change", "id", "rater_id"]).reset_index(drop=True)
+
+"""
+function: import_snapshots
+
+Records the dated copies of the disagreement files in directory (e.g. OI_content_2-16-24.csv) as rounds of
+the history, oldest first, skipping dates that are already recorded. Returns the names of the rounds added.
+"""
+def import_snapshots(history, directory='./disagreed_messages'):
+	rounds = {}
+	for filename in sorted(os.listdir(directory)):
+		match = SNAPSHOT_NAME.match(filename)
+		if(match is None or match.group("metric") not in METRICS):
+			continue
+		date = pd.Timestamp(year=2000 + int(match.group("year")), month=int(match.group("month")), day=int(match.group("day")))
+		rounds.setdefault(date, {})[match.group("metric")] = pd.read_csv(os.path.join(directory, filename), dtype=str, keep_default_na=False)
+
+	added = []
+	for date in sorted(rounds):
+		name = date.strftime("%Y-%m-%d")
+		if(name not in history.rounds):
+			history.record_round(name, rounds[date], recorded_at=str(date))
+			added.append(name)
+	return added
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description='A versioned history of the messages that raters disagreed on.')
+	parser.add_argument('--import-snapshots', action='store_true', help='Record the dated copies in disagreed_messages/ (e.g. OI_content_2-16-24.csv) as rounds of the history.')
+	parser.add_argument('--record', nargs=1, metavar='ROUND', help='Record the current disagreement files in disagreed_messages/ as a round with the given name.')
+	parser.add_argument('--rounds', action='store_true', help='List the recorded rounds.')
+	parser.add_argument('--diff', nargs=2, metavar=('ROUND_A', 'ROUND_B'), help='Show which disagreements were resolved, introduced, or changed between two rounds.')
+	parser.add_argument('--metric', choices=list(METRICS), help='Used with --diff: only compare this metric.')
+	parser.add_argument('--output', help='Used with --diff: save the comparison to this CSV file.')
+	args = parser.parse_args()
+
+	history = DisagreementHistory()
+	if args.import_snapshots:
+		print("Rounds added: " + (", ".join(import_snapshots(history)) or "(none)"))
+	elif args.record:
+		disagreements = {metric: pd.read_csv('./disagreed_messages/' + metric + '.csv', dtype=str, keep_default_na=False) for metric in METRICS if os.path.isfile('./disagreed_messages/' + metric + '.csv')}
+		closed, added = history.record_round(args.record[0], disagreements)
+		print("Recorded round " + args.record[0] + ": " + str(added) + " new disagreements, " + str(closed) + " no longer disagreed on.")
+	elif args.rounds:
+		print(pd.DataFrame(history.vocab["rounds"]).to_string(index=False))
+	elif args.diff:
+		changes = history.diff(args.diff[0], args.diff[1], metric=args.metric)
+		print(changes.groupby(["metric", "change"])["id"].nunique().rename("messages").to_string())
+		if args.output:
+			changes.to_csv(args.output, index=False)
+	else:
+		print("No arguments provided. Usage: --import-snapshots, --record ROUND, --rounds, or --diff ROUND_A ROUND_B")
@@ -0,0 +1,277 @@
+import random
+import re
+import threading
+import time
+from collections import Counter
+from sheet_cache import spreadsheet_key
+
+"""
+An in-process stand-in for the parts of gspread (and the Sheets API) that the scripts use, so that the
+scheduler and the IRR check can be run, timed, and their API calls counted without Google Sheets.
+
+FakeClient implements open_by_url/open_by_key and get_file_drive_metadata; its spreadsheets implement sheet1,
+batch_update (updateCells, setDataValidation, appendDimension and the requests gspread_formatting sends) and
+get_lastUpdateTime; their worksheets implement get_values, col_values, range, acell, cell, find and
+update_cells. Every one of these counts as one API call: it is recorded in FakeClient.calls, takes `latency`
+seconds, and fails with a 429 quota error (FakeAPIError) with probability `quota_error_rate`.
+
+Use it with sheet_client.set_client(FakeClient(...)). Spreadsheets are set up with create_spreadsheet(), and
+their contents can be changed (e.g. to simulate raters) with FakeWorksheet.set_values(), neither of which
+counts as an API call.
+"""
+N_ROWS = 1000
+N_COLS = 26
+
+class FakeAPIError(Exception):
+	def __init__(self, code, message=""):
+		super().__init__(message or "HTTP " + str(code))
+		self.code = code
+		self.response = None
+
+class FakeCell:
+	def __init__(self, row, col, value=""):
+		self.row = row
+		self.col = col
+		self.value = value
+
+	@property
+	def address(self):
+		return column_letter(self.col) + str(self.row)
+
+def column_letter(col):
+	letters = ""
+	while(col > 0):
+		col, remainder = divmod(col - 1, 26)
+		letters = chr(ord("A") + remainder) + letters
+	return letters
+
+def column_number(letters):
+	col = 0
+	for letter in letters:
+		col = col * 26 + ord(letter) - ord("A") + 1
+	return col
+
+A1_CELL = re.compile(r"^([A-Z]*)(\d*)$")
+
+"""
+function: parse_range
+
+Parses an A1 range (e.g. "A3:H", "B:B", "C7") into (first_row, first_col, last_row, last_col); open ends are None.
+"""
+def parse_range(cell_range):
+	cell_range = cell_range.split("!")[-1]
+	start, _, end = cell_range.partition(":")
+	start_col, start_row = A1_CELL.match(start).groups()
+	end_col, end_row = A1_CELL.match(end or start).groups()
+	return (
+		int(start_row) if start_row else 1,
+		column_number(start_col) if start_col else 1,
+		int(end_row) if end_row else None,
+		column_number(end_col) if end_col else None
+	)
+
+class FakeWorksheet:
+	def __init__(self, spreadsheet, sheet_id=0, rows=N_ROWS, cols=N_COLS):
+		self.spreadsheet = spreadsheet
+		self.id = sheet_id
+		self.row_count = rows
+		self.col_count = cols
+		self.cells = {}
+		self.validation = {}
+
+	def _call(self, name):
+		self.spreadsheet.client._call(name)
+
+	def _last_row(self, first_col=1, last_col=None):
+		rows = [row for (row, col), value in self.cells.items() if value != "" and col >= first_col and (last_col is None or col <= last_col)]
+		return max(rows, default=0)
+
+	def _grid(self, cell_range):
+		first_row, first_col, last_row, last_col = parse_range(cell_range)
+		last_col = last_col or self.col_count
+		last_row = last_row or self._last_row(first_col, last_col)
+		return first_row, first_col, last_row, last_col
+
+	"""
+	function: set_values
+
+	Writes rows of values from the given cell down, without counting as an API call (for setting up tests).
+	"""
+	def set_values(self, first_cell, rows):
+		first_row, first_col, _, _ = parse_range(first_cell)
+		for r, row in enumerate(rows):
+			for c, value in enumerate(row):
+				self.cells[(first_row + r, first_col + c)] = str(value)
+		self.row_count = max(self.row_count, first_row + len(rows) - 1)
+		self.spreadsheet.touch()
+
+	def get_values(self, cell_range=None):
+		self._call("get_values")
+		first_row, first_col, last_row, last_col = self._grid(cell_range or "A1:" + column_letter(self.col_count))
+		last_row = min(last_row, self._last_row(first_col, last_col))
+		return [[self.cells.get((row, col), "") for col in range(first_col, last_col + 1)] for row in range(first_row, last_row + 1)]
+
+	def col_values(self, col):
+		self._call("col_values")
+		last_row = self._last_row(col, col)
+		return [self.cells.get((row, col), "") for row in range(1, last_row + 1)]
+
+	def range(self, cell_range):
+		self._call("range")
+		first_row, first_col, last_row, last_col = self._grid(cell_range)
+		return [FakeCell(row, col, self.cells.get((row, col), "")) for row in range(first_row, last_row + 1) for col in range(first_col, last_col + 1)]
+
+	def acell(self, label):
+		self._call("acell")
+		row, col, _, _ = parse_range(label)
+		return FakeCell(row, col, self.cells.get((row, col), ""))
+
+	def cell(self, row, col):
+		self._call("cell")
+		return FakeCell(row, col, self.cells.get((row, col), ""))
+
+	def find(self, query, in_row=None, in_column=None):
+		self._call("find")
+		for (row, col) in sorted(self.cells):
+			if(self.cells[(row, col)] == query and (in_row is None or row == in_row) and (in_column is None or col == in_column)):
+				return FakeCell(row, col, query)
+		return None
+
+	def update_cells(self, cell_list, value_input_option="RAW"):
+		self._call("update_cells")
+		for cell in cell_list:
+			self.cells[(cell.row, cell.col)] = str(cell.value)
+			self.row_count = max(self.row_count, cell.row)
+		self.spreadsheet.touch()
+		return {"updatedCells": len(cell_list)}
+
+class FakeSpreadsheet:
+	def __init__(self, client, key, rows=N_ROWS, cols=N_COLS):
+		self.client = client
+		self.id = key
+		self.revision = 0
+		self.worksheets = [FakeWorksheet(self, 0, rows, cols)]
+
+	def touch(self):
+		self.revision += 1
+
+	@property
+	def sheet1(self):
+		self.client._call("sheet1")
+		return self.worksheets[0]
+
+	def get_lastUpdateTime(self):
+		self.client._call("get_lastUpdateTime")
+		return str(self.revision)
+
+	"""
+	function: fetch_sheet_metadata
+
+	Returns the spreadsheet's properties and those of its worksheets. As in the API, if params has a range
+	(on the first worksheet) and includeGridData, only the first worksheet is returned, with the cell values
+	of that range; empty cells, and empty rows at the end of the range, are left out.
+	"""
+	def fetch_sheet_metadata(self, params=None):
+		self.client._call("fetch_sheet_metadata")
+		params = params or {}
+		sheets = [{"properties": {"sheetId": sh.id, "index": i, "gridProperties": {"rowCount": sh.row_count, "columnCount": sh.col_count}}} for i, sh in enumerate(self.worksheets)]
+		if(not params.get("ranges")):
+			return {"properties": {"title": self.id}, "sheets": sheets}
+		sheet = sheets[0]
+		if(str(params.get("includeGridData")).lower() == "true"):
+			sh = self.worksheets[0]
+			first_row, first_col, last_row, last_col = parse_range(params["ranges"])
+			rows = [[sh.cells.get((row, col), "") for col in range(first_col, (last_col or sh.col_count) + 1)] for row in range(first_row, min(last_row or sh.row_count, sh.row_count) + 1)]
+			while(rows and not any(rows[-1])):
+				rows.pop()
+			sheet["data"] = [{"startRow": first_row - 1, "rowData": [{"values": [{"formattedValue": value} if value != "" else {} for value in row]} if any(row) else {} for row in rows]}]
+		return {"properties": {"title": self.id}, "sheets": [sheet]}
+
+	def _worksheet(self, sheet_id):
+		return next(sh for sh in self.worksheets if sh.id == sheet_id)
+
+	def batch_update(self, body):
+		self.client._call("batch_update")
+		for request in body["requests"]:
+			kind, params = next(iter(request.items()))
+			if(kind == "appendDimension"):
+				sh = self._worksheet(params["sheetId"])
+				if(params["dimension"] == "ROWS"):
+					sh.row_count += params["length"]
+				else:
+					sh.col_count += params["length"]
+			elif(kind == "updateCells"):
+				sh = self._worksheet(params["start"]["sheetId"])
+				start_row, start_col = params["start"].get("rowIndex", 0) + 1, params["start"].get("columnIndex", 0) + 1
+				if(start_row + len(params["rows"]) - 1 > sh.row_count):
+					raise FakeAPIError(400, "Range exceeds grid limits")
+				for r, row in enumerate(params["rows"]):
+					for c, value in enumerate(row.get("values", [])):
+						if("userEnteredValue" in value):
+							sh.cells[(start_row + r, start_col + c)] = str(next(iter(value["userEnteredValue"].values())))
+						if("dataValidation" in value):
+							sh.validation[(start_row + r, start_col + c)] = value["dataValidation"]
+			elif(kind == "setDataValidation"):
+				grid = params["range"]
+				sh = self._worksheet(grid["sheetId"])
+				for row in range(grid["startRowIndex"] + 1, grid["endRowIndex"] + 1):
+					for col in range(grid["startColumnIndex"] + 1, grid["endColumnIndex"] + 1):
+						sh.validation[(row, col)] = params.get("rule")
+			else:
+				raise FakeAPIError(400, "Unsupported request: " + kind)
+		self.touch()
+		return {"replies": [{} for _ in body["requests"]]}
+
+class FakeClient:
+	def __init__(self, latency=0.0, quota_error_rate=0.0, seed=0):
+		self.latency = latency
+		self.quota_error_rate = quota_error_rate
+		self.random = random.Random(seed)
+		self.spreadsheets = {}
+		self.calls = Counter()
+		self.errors = Counter()
+		self.lock = threading.Lock()
+
+	def _call(self, name):
+		with self.lock:
+			self.calls[name] += 1
+			fail = self.random.random() < self.quota_error_rate
+			if(fail):
+				self.errors[name] += 1
+		if(self.latency):
+			time.sleep(self.latency)
+		if(fail):
+			raise FakeAPIError(429, "Quota exceeded for quota metric (fake)")
+
+	def reset_calls(self):
+		with self.lock:
+			self.calls.clear()
+			self.errors.clear()
+
+	"""
+	function: create_spreadsheet
+
+	Creates an empty spreadsheet for the given URL (not an API call), and returns it.
+	"""
+	def create_spreadsheet(self, url, rows=N_ROWS, cols=N_COLS):
+		key = spreadsheet_key(url)
+		self.spreadsheets[key] = FakeSpreadsheet(self, key, rows, cols)
+		return self.spreadsheets[key]
+
+	def _open(self, name, key):
+		self._call(name)
+		if(key not in self.spreadsheets):
+			raise FakeAPIError(404, "Spreadsheet not found: " + key)
+		return self.spreadsheets[key]
+
+	def open_by_key(self, key):
+		return self._open("open_by_key", key)
+
+	def open_by_url(self, url):
+		return self._open("open_by_url", spreadsheet_key(url))
+
+	def get_file_drive_metadata(self, key):
+		self._call("get_file_drive_metadata")
+		if(key not in self.spreadsheets):
+			raise FakeAPIError(404, "File not found: " + key)
+		return {"id": key, "modifiedTime": str(self.spreadsheets[key].revision)}
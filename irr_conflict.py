@@ -1,193 +1,231 @@
-import gspread
-from sklearn.metrics import cohen_kappa_score
-from agreement.metrics import cohens_kappa, krippendorffs_alpha, observed_agreement
-# see documentation @: https://github.com/heolin/agreement/blob/master/src/agreement/metrics.py
-from agreement.utils.transform import pivot_table_frequency
 import pandas as pd
 import numpy as np
-import pprint
-import time
-import json
 from rating_dictionary import RATING_DICTIONARY
+import os
+from agreement_engine import encode_ratings, category_counts, compute_agreement, cluster_sums, bootstrap_statistics, bootstrap_intervals, agreement_breakdowns
+import sheet_client
+from sheet_client import read_sheet_ranges
+from tracing import TRACER, report
 import argparse
-# remove emily's test instance from the dictioary
-RATING_DICTIONARY.pop("xehu")
-
-# Authenticate with Google Sheets
-gc = gspread.service_account(filename='./tpm-data-annotation-aae74b403ab4.json')
+# emily's test instance is left out of the IRR check (and the consensus labels), without removing it from
+# RATING_DICTIONARY itself, which the scheduler (importing METRICS from here) still needs
+TEST_RATERS = {"xehu"}
 
+# Google Sheets are accessed through sheet_client (which authenticates lazily, on the first API call)
 # NOTE: email is: tpm-data-annotation@tpm-data-annotation.iam.gserviceaccount.com
 # Everything needs to be shared with this email address!
 
-"""
-function: get_ratings_for_range()
-
-@param cell_range: The range of cells for which we want to get the
-ratings across all the spreadsheets
-"""
-def get_ratings_for_range(cell_range, list_of_spreadsheet_links):
-	ratings = []
-	
-	for spreadsheet in list_of_spreadsheet_links:
-		values = gc.open_by_url(spreadsheet).sheet1.range(cell_range)
-		values = [value.value for value in values]
-		ratings.append(values)	
-
-	return(ratings)
+# The rated messages start on row 3 of each sheet (after 2 header rows); columns A-H hold
+# CONV_ID, id, speaker, text, and the four ratings
+FIRST_RATED_ROW = 3
+SHEET_COLUMNS = ["A", "B", "C", "D", "E", "F", "G", "H"]
+
+# The metrics we check IRR for: the column where each is rated, the label used when reporting it, and
+# the dict for converting its answers to ints (note: we are going to treat blank labels as 'Neutral')
+METRICS = {
+	"directness_content": {
+		"column": "E",
+		"label": "Directness_content",
+		"conversion": {'Yes - Direct Content': 2, 'Neutral - Content contains no opinion': 0, 'No - Indirect Content': 1, '': 0}
+	},
+	"directness_expression": {
+		"column": "F",
+		"label": "Directness_expression",
+		"conversion": {'Yes - Direct Expression': 2, 'No - Indirect Expression': 1, '': 0}
+	},
+	"OI_content": {
+		"column": "G",
+		"label": "OI_content",
+		"conversion": {'Yes - Content opposes someone else': 2, 'No - Content does not oppose anyone': 1, '': 0}
+	},
+	"OI_expression": {
+		"column": "H",
+		"label": "OI_expression",
+		"conversion": {'Yes - Expression is emotional/forceful': 2, 'No - Expression is not emotional/forceful': 1, '': 0}
+	}
+}
+N_CATEGORIES = 3
 
 """
-function: convert_ratings_to_int
-Convert the ratings (Agree/Neutral/Disagree) to ints.
+function: irr_raters()
 
-@param ratings: the ratings to convert
-@param conversion_dict: the dictionary for converting answers
+Returns {rater_id: spreadsheet URL} for the raters whose sheets are checked for IRR.
 """
-def convert_ratings_to_int(ratings, conversion_dict):
-	# Note: we are going to treat blank labels as 'Neutral'
-	return [[conversion_dict[item] for item in sublist] for sublist in ratings]
+def irr_raters():
+	return({rater_id: url for rater_id, url in RATING_DICTIONARY.items() if rater_id not in TEST_RATERS})
 
 """
-function: convert_ratings_to_question_rater_answer
+function: get_rating_blocks()
 
-Converts the ratings to a matrix of [question, rater, answer
+Reads columns A-H (from row 3 down) of every rater's sheet: one open and one range read per rater,
+fanned out across raters. Returns one list of rows per spreadsheet, each padded to 8 columns.
+revisions (optional) are the sheets' current revisions, if already known (see sheet_client.read_revisions).
 """
-def convert_ratings_to_question_rater_answer(ratings, conversion_dict):
-	ratings = convert_ratings_to_int(ratings, conversion_dict)
-	num_questions = len(ratings[0])
-	transformed_data = []
-	for question_id in range(1, num_questions + 1):
-		for rater_id, response in enumerate(ratings):
-			transformed_data.append([question_id, rater_id + 1, response[question_id - 1]])
-	dataset = np.array(transformed_data)
-	return dataset
+def get_rating_blocks(list_of_spreadsheet_links, revisions=None):
+	blocks = read_sheet_ranges(list_of_spreadsheet_links, "A{}:H".format(FIRST_RATED_ROW), revisions=revisions)
+	return([[row + [''] * (len(SHEET_COLUMNS) - len(row)) for row in values] for values in blocks])
 
+def _block_array(block):
+	return(np.array(block, dtype=object).reshape(len(block), len(SHEET_COLUMNS)))
 
-def next_available_row(worksheet, colnum=8):
-	# Modified from: https://stackoverflow.com/questions/40781295/how-to-find-the-first-empty-row-of-a-google-spread-sheet-using-python-gspread
-	str_list = list(filter(None, worksheet.col_values(colnum)))
-	return len(str_list)+2
+"""
+function: shared_rated_rows()
 
+Matches the messages across the raters' sheets by (CONV_ID, id), since raters who were not given exactly the
+same conversations (e.g. by --schedule-batch with an overlap below 1) have different messages on the same row.
+A message counts as rated once its final rating column (H) is filled in.
 
-def get_disagreed_messages(questions_answers_table):
+Returns a (raters x messages) array with the position of each message in each rater's block, for the messages
+that every rater has rated, in the order of the first rater's sheet.
+"""
+def shared_rated_rows(blocks):
+	positions = []
+	keys = []
+	for block in blocks:
+		block = _block_array(block)
+		sheet_keys = pd.MultiIndex.from_arrays([block[:, SHEET_COLUMNS.index("A")].astype(str), block[:, SHEET_COLUMNS.index("B")].astype(str)])
+		# a message that was allocated twice to the same rater is matched by its first rated row
+		rated = np.flatnonzero(block[:, SHEET_COLUMNS.index("H")] != '')
+		rated = rated[~sheet_keys[rated].duplicated()]
+		positions.append(rated)
+		keys.append(sheet_keys[rated])
+
+	shared = keys[0] if keys else pd.MultiIndex.from_arrays([[], []])
+	for rater_keys in keys[1:]:
+		shared = shared[shared.isin(rater_keys)]
+	return(np.array([rater_positions[rater_keys.get_indexer(shared)] for rater_positions, rater_keys in zip(positions, keys)], dtype=np.int64).reshape(len(blocks), len(shared)))
 
-	print(questions_answers_table)
+"""
+function: get_answers()
 
-	disagreed_indices = np.where(np.all(questions_answers_table != 3, axis=1))[0]
+Pulls the raw answers for the given metrics out of the rating blocks, for the rows from shared_rated_rows.
+Returns an array of shape (raters, items, metrics).
+"""
+def get_answers(blocks, rows, metrics=METRICS):
+	col_indices = [SHEET_COLUMNS.index(metric["column"]) for metric in metrics.values()]
+	return(np.array([_block_array(block)[rater_rows][:, col_indices] for block, rater_rows in zip(blocks, rows)], dtype=object).reshape(len(blocks), rows.shape[1], len(col_indices)))
 
-	print(disagreed_indices)
+"""
+function: get_conversation_ids()
 
-	disagreed_messages = {} # Format -- {id: text}
-	for index in disagreed_indices:
-		sh = gc.open_by_url(list(RATING_DICTIONARY.values())[0]).sheet1 # open just the first sheet
-		ID_COL = "B"
-		TEXT_COL = "D"
+Returns the CONV_ID of each rated message (column A of the first rater's sheet), for the rows from shared_rated_rows.
+"""
+def get_conversation_ids(blocks, rows):
+	return(_block_array(blocks[0])[rows[0], SHEET_COLUMNS.index("A")])
 
-		disag_id = sh.acell(ID_COL + str(index + 3)).value  # + 3 because there are 2 header rows, plus zero indexing
-		disag_text = sh.acell(TEXT_COL + str(index + 3)).value
+"""
+function: get_category_labels()
 
-		disagreed_messages[disag_id] = disag_text
+Inverts a conversion dict, so that each integer category can be reported with the answer(s) it stands for.
+"""
+def get_category_labels(conversion_dict):
+	labels = {}
+	for answer, category in conversion_dict.items():
+		labels.setdefault(category, []).append(answer if answer != '' else "(blank)")
+	return({category: " / ".join(answers) for category, answers in labels.items()})
 
-		if(index > 0 and index % 10 == 0):
-			print(str(index) + " requests completed...")
-			if(index%20 == 0):
-				time.sleep(10)
-	
-	disagreed_messages_df = pd.DataFrame(list(disagreed_messages.items()), columns=['id', 'text'])
-	return(disagreed_messages_df)
+"""
+function: get_disagreed_messages
+
+Finds the messages that the raters did not all agree on, and returns one row per (message, rater), with
+the message's id and text (taken from the rating blocks already read from the first rater's sheet) and
+that rater's answer (in the `rating_[metric]` column).
+
+@param questions_answers_table: the (message x answer) frequency table for the metric
+@param ratings: the raw answers for the metric, one list per rater (a metric's slice of get_answers)
+@param rating_blocks: the rows read from each rater's sheet (as returned by get_rating_blocks)
+@param rows: the position of each message in each rater's block (as returned by shared_rated_rows)
+@param metric: the name of the metric (e.g. OI_content)
+@param rater_ids: the rater IDs, in the same order as ratings
+"""
+def get_disagreed_messages(questions_answers_table, ratings, rating_blocks, rows, metric, rater_ids):
+	n_raters = len(ratings)
+	disagreed_indices = np.where(questions_answers_table.max(axis=1) < n_raters)[0]
+
+	first_block = _block_array(rating_blocks[0])[rows[0]]
+	answers = np.array(ratings, dtype=object)
+	return(pd.DataFrame({
+		"id": np.repeat(first_block[disagreed_indices, SHEET_COLUMNS.index("B")], n_raters),
+		"text": np.repeat(first_block[disagreed_indices, SHEET_COLUMNS.index("D")], n_raters),
+		"rating_" + metric: answers[:, disagreed_indices].T.ravel(),
+		"rater_id": np.tile(list(rater_ids), len(disagreed_indices))
+	}))
 
 if __name__ == "__main__":
 
-	# Constants for where directness and oppositional intensity are rated
-	DIRECTNESS_CONTENT_COL = "E"
-	DIRECTNESS_EXPRESSION_COL = "F"
-	OI_CONTENT_COL = "G"
-	OI_EXPRESSION_COL = "H"
-
-	# Conversion dicts for different questions
-	conversion_directness_content = {'Yes - Direct Content': 2, 'Neutral - Content contains no opinion': 0, 'No - Indirect Content': 1, '': 0}
-	conversion_directness_expression = {'Yes - Direct Expression': 2, 'No - Indirect Expression': 1, '': 0}
-	conversion_OI_content = {'Yes - Content opposes someone else': 2, 'No - Content does not oppose anyone': 1, '': 0}
-	conversion_OI_expression = {'Yes - Expression is emotional/forceful': 2, 'No - Expression is not emotional/forceful': 1, '': 0}
-
-
 	parser = argparse.ArgumentParser(description='This script checks inter-rater reliability for the conflict portion of the Team Process Mapping project.')
 	parser.add_argument('--check', nargs=1, help='Check the specific IRR for a single one of the metrics. You need to pass in 1 argument for which of the 4: directness_content, directness_expression, OI_content, or OI_expression.')
+	parser.add_argument('--bootstrap', type=int, default=0, help='Number of bootstrap replicates for confidence intervals around each statistic (resampling whole conversations). Default: 0 (no intervals).')
+	parser.add_argument('--jobs', type=int, default=1, help='Number of processes to spread the bootstrap replicates across (default: 1).')
+	parser.add_argument('--breakdown', action='store_true', help='Also save agreement broken down per conversation, per rater pair, and per label category under ./output/.')
+	parser.add_argument('--offline', action='store_true', help='Compute IRR purely from the last cached snapshot of each sheet, without calling the Sheets API.')
+	parser.add_argument('--cache-ttl', type=float, default=sheet_client.SHEET_CACHE.ttl, help='Seconds for which a cached sheet snapshot is used without checking whether the sheet has changed (default: %(default)s).')
+	parser.add_argument('--trace', nargs='?', const='', help='Print a summary of where the run spent its time (every Sheets API call, and each local stage). If a path is given, every call and stage is also written to it as JSON lines.')
 	args = parser.parse_args()
-
-	# Get the end of where we should be checking for IRR
-	avail_rows = []
-
-	for rater_sheet in RATING_DICTIONARY.values():
-		sh = gc.open_by_url(rater_sheet).sheet1
-		# get where the labels end
-		next_row = next_available_row(sh) # Figure out the next open line
-		avail_rows.append(next_row)
-
-	# This is the end of where we should be checking for IRR
-	last_rated_row = min(avail_rows)-1
-
-	if(last_rated_row) < 3:
+	if args.trace is not None:
+		TRACER.enable(args.trace)
+	sheet_client.SHEET_CACHE.offline = args.offline
+	sheet_client.SHEET_CACHE.ttl = args.cache_ttl
+	sheet_client.SHEET_CACHE.evict()
+
+	if args.check:
+		if args.check[0] not in METRICS:
+			raise ValueError('Please provide one of the following 4 metric names: directness_content, directness_expression, OI_content, or OI_expression.')
+		metrics = {args.check[0]: METRICS[args.check[0]]}
+	else: # Default IRR check: all of the metrics
+		metrics = METRICS
+
+	# Read every rater's sheet once; all of the metrics are pulled out of these blocks
+	with TRACER.stage("read sheets"):
+		raters = irr_raters()
+		rating_blocks = get_rating_blocks(raters.values())
+
+	# The messages that every rater has rated (matched across the sheets by CONV_ID and id)
+	rows = shared_rated_rows(rating_blocks)
+
+	if(rows.shape[1] == 0):
 		print("Not enough ratings!")
 
 	else:
+		# One (raters x messages x metrics) array holds every rating we check
+		with TRACER.stage("agreement"):
+			answers = get_answers(rating_blocks, rows, metrics)
+			ratings = encode_ratings(answers, [metric["conversion"] for metric in metrics.values()])
+			summary, pairwise = compute_agreement(ratings, N_CATEGORIES, list(metrics), raters.keys())
+
 		if args.check:
-			metric_to_check = args.check[0]
-
-			if metric_to_check == "directness_content":
-				COL = DIRECTNESS_CONTENT_COL
-				conversion_dict = conversion_directness_content
-			elif metric_to_check == "directness_expression":
-				COL = DIRECTNESS_EXPRESSION_COL
-				conversion_dict = conversion_directness_expression
-			elif metric_to_check == "OI_content":
-				COL = OI_CONTENT_COL
-				conversion_dict = conversion_OI_content
-			elif metric_to_check == "OI_expression":
-				COL = OI_EXPRESSION_COL
-				conversion_dict = conversion_OI_expression
-			else:
-				raise ValueError('Please provide one of the following 4 metric names: directness_content, directness_expression, OI_content, or OI_expression.')
-
-			# get the range for which we are checking irr
-			content = COL+"3:" + COL+str(last_rated_row)
-			content_ratings = get_ratings_for_range(content, RATING_DICTIONARY.values())
-			datatable = convert_ratings_to_question_rater_answer(content_ratings, conversion_dict)
-		
-			questions_answers_table = pivot_table_frequency(datatable[:, 0], datatable[:, 2])
-
-			print("Agreement for " + metric_to_check + ": " + str(observed_agreement(questions_answers_table)))
-			get_disagreed_messages(questions_answers_table).to_csv('./disagreed_messages/' + metric_to_check + '.csv')
-
-		else: # Default IRR check	
-			# Agreement
-			AGREEMENT = {}
-
-			# Specify where we should be checking IRR
-			directness_content = DIRECTNESS_CONTENT_COL+"3:" + DIRECTNESS_CONTENT_COL+str(last_rated_row)
-			directness_expression = DIRECTNESS_EXPRESSION_COL+"3:" + DIRECTNESS_EXPRESSION_COL+ str(last_rated_row)
-			OI_content = OI_CONTENT_COL+"3:" + OI_CONTENT_COL+str(last_rated_row)
-			OI_expression = OI_EXPRESSION_COL+"3:" + OI_EXPRESSION_COL+str(last_rated_row)
-
-			# Directness
-			directness_content_ratings = get_ratings_for_range(directness_content, RATING_DICTIONARY.values())
-			dc_datatable = convert_ratings_to_question_rater_answer(directness_content_ratings, conversion_directness_content)
-			dc_questions_answers_table = pivot_table_frequency(dc_datatable[:, 0], dc_datatable[:, 2])
-			AGREEMENT["Directness_content"] = observed_agreement(dc_questions_answers_table)
-			
-			directness_expression_ratings = get_ratings_for_range(directness_expression, RATING_DICTIONARY.values())
-			de_datatable = convert_ratings_to_question_rater_answer(directness_expression_ratings, conversion_directness_expression)
-			de_questions_answers_table = pivot_table_frequency(de_datatable[:, 0], de_datatable[:, 2])
-			AGREEMENT["Directness_expression"] = observed_agreement(de_questions_answers_table)
-
-			# Oppositional Intensity
-			OI_content_ratings = get_ratings_for_range(OI_content, RATING_DICTIONARY.values())
-			OIc_datatable = convert_ratings_to_question_rater_answer(OI_content_ratings, conversion_OI_content)
-			OIc_questions_answers_table = pivot_table_frequency(OIc_datatable[:, 0], OIc_datatable[:, 2])
-			AGREEMENT["OI_content"] = observed_agreement(OIc_questions_answers_table)
-			
-			OI_expression_ratings = get_ratings_for_range(OI_expression, RATING_DICTIONARY.values())
-			OIe_datatable = convert_ratings_to_question_rater_answer(OI_expression_ratings, conversion_OI_expression)
-			OIe_questions_answers_table = pivot_table_frequency(OIe_datatable[:, 0], OIe_datatable[:, 2])
-			AGREEMENT["OI_expression"] = observed_agreement(OIe_questions_answers_table)
-
-			print(AGREEMENT)
\ No newline at end of file
+			print("Agreement for " + args.check[0] + ": " + str(summary["observed_agreement"].iloc[0]))
+		else:
+			AGREEMENT = {metric["label"]: summary.loc[name, "observed_agreement"] for name, metric in metrics.items()}
+			print(AGREEMENT)
+		print(summary.to_string())
+		print(pairwise.to_string(index=False))
+
+		if(args.bootstrap > 0 or args.breakdown):
+			os.makedirs("./output", exist_ok=True)
+			conversations, clusters = np.unique(get_conversation_ids(rating_blocks, rows).astype(str), return_inverse=True)
+
+		if(args.bootstrap > 0):
+			# Confidence intervals, resampling conversations (rather than messages) with replacement
+			with TRACER.stage("bootstrap"):
+				sums = cluster_sums(ratings, N_CATEGORIES, clusters, len(conversations))
+				replicates = bootstrap_statistics(sums, n_replicates=args.bootstrap, n_jobs=args.jobs)
+				intervals, pairwise_intervals = bootstrap_intervals(sums, replicates, list(metrics), raters.keys())
+			print(intervals.to_string(index=False))
+			intervals.to_csv("./output/irr_bootstrap_intervals.csv", index=False)
+			pairwise_intervals.to_csv("./output/irr_bootstrap_intervals_per_rater_pair.csv", index=False)
+
+		if(args.breakdown):
+			with TRACER.stage("breakdown"):
+				breakdowns = agreement_breakdowns(ratings, N_CATEGORIES, conversations[clusters], list(metrics), raters.keys(), [get_category_labels(metric["conversion"]) for metric in metrics.values()])
+			for name, breakdown in breakdowns.items():
+				breakdown.to_csv("./output/irr_" + name + ".csv", index=False)
+			print(breakdowns["per_category"].to_string(index=False))
+
+		# Save the messages that raters disagreed on, for each metric
+		with TRACER.stage("disagreement files"):
+			counts = category_counts(ratings, N_CATEGORIES)
+			for metric_index, metric in enumerate(metrics):
+				get_disagreed_messages(counts[:, metric_index, :], answers[:, :, metric_index].tolist(), rating_blocks, rows, metric, raters.keys()).to_csv('./disagreed_messages/' + metric + '.csv')
+
+	report()
@@ -0,0 +1,216 @@
+import pandas as pd
+import hashlib
+import io
+import os
+import sqlite3
+import tempfile
+
+"""
+The conversation labeling log stores all of the samples that we have allocated to users,
+as well as the latest ratings.
+
+Here's what each column in the conversation log should contain:
+- CONV_ID: the id associated with the conversation
+- id: the id associated with each message/chat
+- rating_directness_content: the rating for directness assigned by the rater (content)
+- rating_directness_expression: the rating for directness assigned by the rater (expression)
+- rating_OI_content: the rating for directness assigned by the rater (content)
+- rating_OI_expression: the rating for directness assigned by the rater (expression)
+- rater_id: the userid of the rater
+- status: {allocated, done}
+- last_updated_time: time associated with the last update / check to this log item
+
+A log entry is identified by (rater_id, CONV_ID, id). Two backends are available:
+- "csv": CONFLICT_CONVO_LABELING_LOG.csv, with one row per entry. New entries are appended to the end of the
+  file; an upsert that changes existing entries rewrites the file, with each entry kept in its place.
+- "sqlite": CONFLICT_CONVO_LABELING_LOG.db. Entries are upserted in a transaction, and the table is indexed
+  for the per-rater and per-conversation lookups that the scheduler makes. This is the backend to use when
+  running the scheduler for several raters in parallel.
+"""
+LOG_COLUMNS = ["CONV_ID", "id", "rating_directness_content", "rating_directness_expression", "rating_OI_content", "rating_OI_expression", "rater_id", "status", "last_updated_time"]
+LOG_KEY = ["rater_id", "CONV_ID", "id"]
+
+CSV_LOG_PATH = './CONFLICT_CONVO_LABELING_LOG.csv'
+SQLITE_LOG_PATH = './CONFLICT_CONVO_LABELING_LOG.db'
+
+class CSVLabelLog:
+	def __init__(self, path=CSV_LOG_PATH):
+		self.path = path
+		if(not os.path.isfile(self.path)):
+			# define a simple CSV with just the headers
+			pd.DataFrame(columns=LOG_COLUMNS).to_csv(self.path, index=False)
+
+	def read(self, rater_id=None, status=None):
+		label_log = pd.read_csv(self.path, dtype=str)
+		label_log = label_log.drop_duplicates(subset=LOG_KEY, keep="last")
+		if(rater_id is not None):
+			label_log = label_log[label_log["rater_id"] == rater_id]
+		if(status is not None):
+			label_log = label_log[label_log["status"] == status]
+		return label_log.reset_index(drop=True)
+
+	"""
+	function: upsert
+
+	Appends the rows for new entries. If any of the rows are for entries already in the log, the file is
+	rewritten instead (through a temporary file), so that it always holds one row per entry for anything
+	that reads it directly.
+	"""
+	def upsert(self, rows):
+		rows = rows[LOG_COLUMNS]
+		label_log = pd.read_csv(self.path, dtype=str)
+		existing = pd.MultiIndex.from_frame(label_log[LOG_KEY])
+		incoming = pd.MultiIndex.from_frame(rows[LOG_KEY].astype(str))
+		if(not incoming.isin(existing).any() and not incoming.duplicated().any()):
+			rows.to_csv(self.path, mode='a', header=False, index=False)
+			return
+		merged = pd.concat([label_log, rows.astype({col: str for col in LOG_KEY})], ignore_index=True)
+		# keep the latest values of each entry, at the position where the entry first appeared
+		merged["first_row"] = merged.groupby(LOG_KEY, sort=False, dropna=False).ngroup()
+		merged = merged.drop_duplicates(subset=LOG_KEY, keep="last").sort_values("first_row", kind="stable")
+		with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp", delete=False, newline="") as f:
+			merged[LOG_COLUMNS].to_csv(f, index=False)
+		os.replace(f.name, self.path)
+
+	"""
+	function: _prefix_digest
+
+	Returns a SHA-1 of the first `offset` bytes of the (open) file, or None if the file is shorter than that.
+	"""
+	def _prefix_digest(self, f, offset):
+		f.seek(0)
+		digest = hashlib.sha1()
+		remaining = offset
+		while(remaining > 0):
+			chunk = f.read(min(remaining, 1 << 20))
+			if(not chunk):
+				return None
+			digest.update(chunk)
+			remaining -= len(chunk)
+		return digest
+
+	"""
+	function: read_since
+
+	Returns the entries written since `position` (as returned by a previous call), the new position, and
+	whether the entries are the whole log (because position is None, or the file has been rewritten since).
+	Since new entries are appended, the position is a byte offset into the file, saved with a SHA-1 of every
+	byte before it. If the file has been rewritten (by an upsert of existing entries) or replaced or edited
+	(e.g. by a git pull, a hand edit, or --export-log) so that the offset no longer falls at the end of a
+	line, or the bytes before it have changed, the whole log is returned instead.
+	"""
+	def read_since(self, position=None):
+		with open(self.path, "rb") as f:
+			header = f.readline()
+			size = os.fstat(f.fileno()).st_size
+			digest = None
+			if(isinstance(position, dict) and len(header) <= position.get("offset", -1) <= size):
+				f.seek(position["offset"] - 1)
+				if(f.read(1) == b"\n"):
+					digest = self._prefix_digest(f, position["offset"])
+				if(digest is not None and digest.hexdigest() != position.get("sha1")):
+					digest = None
+			complete = digest is None
+			start = len(header) if complete else position["offset"]
+			if(complete):
+				digest = hashlib.sha1(header)
+			f.seek(start)
+			data = f.read()
+		# leave a partially written last line for the next read
+		data = data[:data.rfind(b"\n") + 1]
+		digest.update(data)
+		return pd.read_csv(io.BytesIO(header + data), dtype=str), {"offset": start + len(data), "sha1": digest.hexdigest()}, complete
+
+	"""
+	function: export_csv
+
+	Writes the current state of the log (one row per entry) to a CSV file.
+	"""
+	def export_csv(self, path):
+		self.read().to_csv(path, index=False)
+
+class SQLiteLabelLog:
+	def __init__(self, path=SQLITE_LOG_PATH):
+		self.path = path
+		# wait for (rather than fail on) a write lock held by a concurrent scheduler run
+		self.conn = sqlite3.connect(self.path, timeout=60)
+		self.conn.execute("PRAGMA journal_mode=WAL")
+		with self.conn:
+			self.conn.execute("CREATE TABLE IF NOT EXISTS label_log (" + ", ".join('"{}" TEXT'.format(col) for col in LOG_COLUMNS) + ", UNIQUE (rater_id, CONV_ID, id))")
+			self.conn.execute("CREATE INDEX IF NOT EXISTS label_log_rater_id ON label_log (rater_id, id)")
+			self.conn.execute("CREATE INDEX IF NOT EXISTS label_log_rater_status ON label_log (rater_id, status)")
+			self.conn.execute("CREATE INDEX IF NOT EXISTS label_log_conv ON label_log (CONV_ID)")
+
+	def is_empty(self):
+		return self.conn.execute("SELECT 1 FROM label_log LIMIT 1").fetchone() is None
+
+	def read(self, rater_id=None, status=None):
+		conditions = []
+		params = []
+		if(rater_id is not None):
+			conditions.append("rater_id = ?")
+			params.append(rater_id)
+		if(status is not None):
+			conditions.append("status = ?")
+			params.append(status)
+		query = "SELECT " + ", ".join('"{}"'.format(col) for col in LOG_COLUMNS) + " FROM label_log"
+		if(conditions):
+			query += " WHERE " + " AND ".join(conditions)
+		return pd.read_sql_query(query + " ORDER BY rowid", self.conn, params=params)
+
+	def upsert(self, rows):
+		records = [[None if pd.isna(value) else str(value) for value in row] for row in rows[LOG_COLUMNS].itertuples(index=False)]
+		columns = ", ".join('"{}"'.format(col) for col in LOG_COLUMNS)
+		updates = ", ".join('"{0}" = excluded."{0}"'.format(col) for col in LOG_COLUMNS if col not in LOG_KEY)
+		with self.conn:
+			self.conn.executemany(
+				"INSERT INTO label_log (" + columns + ") VALUES (" + ", ".join("?" * len(LOG_COLUMNS)) + ") "
+				"ON CONFLICT (rater_id, CONV_ID, id) DO UPDATE SET " + updates,
+				records
+			)
+
+	"""
+	function: read_since
+
+	Returns the entries inserted since `position` (as returned by a previous call), the new position, and
+	whether the entries are the whole log (because position is None, or the database has been recreated since).
+	The position is the largest rowid read; updates of existing entries keep their rowid.
+	"""
+	def read_since(self, position=None):
+		last = self.conn.execute("SELECT MAX(rowid) FROM label_log").fetchone()[0] or 0
+		complete = position is None or position > last
+		query = "SELECT " + ", ".join('"{}"'.format(col) for col in LOG_COLUMNS) + " FROM label_log WHERE rowid > ? AND rowid <= ? ORDER BY rowid"
+		return pd.read_sql_query(query, self.conn, params=[0 if complete else position, last]), last, complete
+
+	"""
+	function: import_csv
+
+	One-time migration: upserts every entry of an existing CSV log into the database.
+	"""
+	def import_csv(self, path=CSV_LOG_PATH):
+		self.upsert(CSVLabelLog(path).read())
+
+	"""
+	function: export_csv
+
+	Writes the current state of the log (one row per entry) to a CSV file.
+	"""
+	def export_csv(self, path):
+		self.read().to_csv(path, index=False)
+
+"""
+function: open_label_log
+
+Opens the labeling log with the given backend ("csv" or "sqlite"). The first time the SQLite backend is
+opened, it is populated from the existing CSV log.
+"""
+def open_label_log(backend="csv"):
+	if(backend == "csv"):
+		return CSVLabelLog()
+	elif(backend == "sqlite"):
+		label_log = SQLiteLabelLog()
+		if(label_log.is_empty() and os.path.isfile(CSV_LOG_PATH)):
+			label_log.import_csv(CSV_LOG_PATH)
+		return label_log
+	else:
+		raise ValueError('Please provide one of the following log backends: csv, sqlite.')
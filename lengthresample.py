@@ -3,6 +3,9 @@ import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 import seaborn as sns
 import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from stratified_resample import stratified_indices, DEFAULT_SEED
 
 # Function to read and filter data from CSV
 def read_csv(csv_file_path):
@@ -16,39 +19,37 @@ def read_csv(csv_file_path):
     return winning_data, awry_data
 
 # Function to resample data to balance counts
-def resample_data(winning_data, awry_data):
-    # Count occurrences of each unique value in both datasets
-    winning_counts = winning_data.value_counts()
-    awry_counts = awry_data.value_counts()
-
-    # Identify all unique values across both datasets
-    unique_values = set(winning_counts.index).union(set(awry_counts.index))
-
-    # Determine minimum counts to balance datasets
-    new_counts = {val: min(winning_counts.get(val, 0), awry_counts.get(val, 0)) for val in unique_values}
-
-    # Resample data based on the determined counts
-    new_winning = pd.concat([winning_data[winning_data == key].sample(n=value) for key, value in new_counts.items()])
-    new_awry = pd.concat([awry_data[awry_data == key].sample(n=value) for key, value in new_counts.items()])
+def resample_data(winning_data, awry_data, features=None, bins=None, seed=DEFAULT_SEED):
+    # A single feature (Series) can be passed in, or a DataFrame with the features to balance on
+    single_feature = isinstance(winning_data, pd.Series)
+    if single_feature:
+        winning_data, awry_data = winning_data.to_frame(), awry_data.to_frame()
+    features = features or list(winning_data.columns)
+
+    # Match the datasets on every feature at once (see stratified_resample.py)
+    winning_indices, awry_indices = stratified_indices(winning_data, awry_data, features, bins=bins, seed=seed)
+    new_winning = winning_data.iloc[winning_indices]
+    new_awry = awry_data.iloc[awry_indices]
+    if single_feature:
+        new_winning, new_awry = new_winning.iloc[:, 0], new_awry.iloc[:, 0]
 
     # Create 'output' directory if it does not exist
     os.makedirs("./output", exist_ok=True)
 
     # Save resampled data to CSV
-    new_winning.to_csv('./output/Dataset_conversation_length_resampled.csv', index=False)
+    new_winning.to_csv(f'./output/Dataset_{features[0] if len(features) == 1 else "multifeature"}_resampled.csv', index=False)
 
     return new_winning, new_awry
 
 # Function to describe dataset and save descriptive statistics
 def describe_data(df, dataset_type=""):
-    # Create a copy of the dataset to avoid modifying the original data
-    df_copy = df.copy()
+    # Generate descriptive statistics (without modifying or copying the original data)
+    describe_df = df.describe().T
 
-    # Rename columns based on the dataset type
-    df_copy.columns = [f"{1 if dataset_type == 'Winning' else 0}_{dataset_type}_{col}" for col in df_copy.columns]
+    # Rename the features based on the dataset type
+    describe_df.index = [f"{1 if dataset_type == 'Winning' else 0}_{dataset_type}_{col}" for col in describe_df.index]
 
-    # Generate descriptive statistics and save to CSV
-    describe_df = df_copy.describe().T
+    # Save to CSV
     describe_df.to_csv(f'./output/Dataset_{1 if dataset_type == "Winning" else 0}_{dataset_type}_describe.csv', sep=',')
 
 # Function to draw KDE plot for resampled data
@@ -64,18 +65,65 @@ def draw_image(new_winning, new_awry, feature="conversation_length"):
         pdf.savefig()
         plt.close()
 
+# Function to compute descriptive statistics for many features of both datasets at once
+def describe_features(winning_data, awry_data, features):
+    # describe() computes every statistic for all of the selected columns in one pass
+    stats = pd.concat({"1_Winning": winning_data[features].describe().T, "0_Awry": awry_data[features].describe().T}, axis=1)
+    stats.columns = [f"{dataset}_{stat}" for dataset, stat in stats.columns]
+    stats["mean_difference"] = stats["1_Winning_mean"] - stats["0_Awry_mean"]
+    stats.index.name = "feature"
+    return stats
+
+# Function to draw the KDE plot for a single feature (run in a worker process); returns the figure
+def draw_feature_figure(feature, winning_values, awry_values):
+    fig, ax = plt.subplots()
+    sns.kdeplot(winning_values, color='red', fill=True, label='Dataset_1_Winning', ax=ax)
+    sns.kdeplot(awry_values, color='black', fill=True, label='Dataset_0_Awry', ax=ax)
+    ax.set_title(feature)
+    ax.legend()
+    plt.close(fig)
+    return fig
+
+# Function to compare the distributions of many features, saving one multi-page PDF and one stats CSV
+def report_features(winning_data, awry_data, features=None, jobs=None, name="feature_report"):
+    # By default, report on every numeric feature
+    if not features:
+        features = [col for col in winning_data.select_dtypes("number").columns if col != "dataset_numeric"]
+
+    # Create 'output' directory if it does not exist
+    os.makedirs("./output", exist_ok=True)
+
+    stats = describe_features(winning_data, awry_data, features)
+    stats.to_csv(f'./output/{name}_stats.csv')
+
+    # The plots are drawn across a pool of processes (each is only sent the two columns it plots),
+    # and collected into one PDF, one page per feature, in the order of features
+    with ProcessPoolExecutor(max_workers=jobs) as pool, PdfPages(f'./output/{name}.pdf') as pdf:
+        winning_values = (winning_data[feature].to_numpy() for feature in features)
+        awry_values = (awry_data[feature].to_numpy() for feature in features)
+        for fig in pool.map(draw_feature_figure, features, winning_values, awry_values):
+            pdf.savefig(fig)
+
+    return stats
+
 if __name__ == "__main__":
-    # Path to the CSV file containing the dataset
-    csv_file_path = "tpm_with_xgboost_noreg_reduced_dim.csv"
+    parser = argparse.ArgumentParser(description='Resamples the winning and awry conversations to match on conversation length, or reports on the distributions of many features.')
+    parser.add_argument('--csv', default="tpm_with_xgboost_noreg_reduced_dim.csv", help='Path to the CSV file containing the dataset (default: %(default)s).')
+    parser.add_argument('--report', nargs='*', metavar='FEATURE', help='Compare winning vs. awry for the given features (or, with no features, every numeric column), saving ./output/feature_report.pdf (one page per feature) and ./output/feature_report_stats.csv.')
+    parser.add_argument('--jobs', type=int, default=None, help='Number of processes to draw the report plots with (default: one per CPU).')
+    args = parser.parse_args()
 
     # Read and filter dataset into 'winning' and 'awry' subsets
-    winning_data, awry_data = read_csv(csv_file_path)
+    winning_data, awry_data = read_csv(args.csv)
 
-    # Specify the feature for analysis
-    feature = "conversation_length"
+    if args.report is not None:
+        report_features(winning_data, awry_data, features=args.report, jobs=args.jobs)
+    else:
+        # Specify the feature for analysis
+        feature = "conversation_length"
 
-    # Resample data for the specified feature
-    new_winning, new_awry = resample_data(winning_data[feature], awry_data[feature])
+        # Resample data for the specified feature
+        new_winning, new_awry = resample_data(winning_data[feature], awry_data[feature])
 
-    # Draw KDE plot to visualize the resampled data distribution
-    draw_image(new_winning, new_awry, feature=feature)
+        # Draw KDE plot to visualize the resampled data distribution
+        draw_image(new_winning, new_awry, feature=feature)
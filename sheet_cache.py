@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+"""
+On-disk snapshots of the ranges we read from the raters' Google Sheets.
+
+Each snapshot is keyed by spreadsheet URL and range, and records the spreadsheet's revision (its Drive
+`modifiedTime`) at the time it was read. A read is served from the snapshot:
+- without any API call, if the snapshot is younger than `ttl` seconds
+- after a single Drive metadata call, if the spreadsheet has not been modified since the snapshot was taken
+- without any API call at all, in offline mode (an error is raised if there is no snapshot)
+
+A snapshot of an open-ended range (e.g. "A3:H") also serves reads of the same columns starting further down
+(e.g. "A453:H"). Snapshots that have not been used for `evict_after` seconds are deleted.
+"""
+CACHE_DIR = './.sheet_cache'
+DEFAULT_TTL = 60
+DEFAULT_EVICT_AFTER = 7 * 24 * 60 * 60
+
+OPEN_ENDED_RANGE = re.compile(r"^([A-Z]+)(\d+):([A-Z]+)$")
+
+def spreadsheet_key(spreadsheet_url):
+	match = re.search(r"/d/([a-zA-Z0-9-_]+)", spreadsheet_url)
+	return match.group(1) if match else spreadsheet_url
+
+def _digest(value):
+	return hashlib.sha1(value.encode("utf-8")).hexdigest()
+
+"""
+function: spreadsheet_revision
+
+Returns the Drive modifiedTime of a spreadsheet, or None if the client can't report it.
+"""
+def spreadsheet_revision(client, spreadsheet_url):
+	if(hasattr(client, "get_file_drive_metadata")):
+		return client.get_file_drive_metadata(spreadsheet_key(spreadsheet_url))["modifiedTime"]
+	spreadsheet = client.open_by_url(spreadsheet_url)
+	if(hasattr(spreadsheet, "get_lastUpdateTime")):
+		return spreadsheet.get_lastUpdateTime()
+	return None
+
+class SheetCache:
+	def __init__(self, cache_dir=CACHE_DIR, ttl=DEFAULT_TTL, evict_after=DEFAULT_EVICT_AFTER, offline=False):
+		self.cache_dir = cache_dir
+		self.ttl = ttl
+		self.evict_after = evict_after
+		self.offline = offline
+
+	def _sheet_dir(self, spreadsheet_url):
+		return os.path.join(self.cache_dir, _digest(spreadsheet_url))
+
+	def _snapshot_path(self, spreadsheet_url, cell_range):
+		return os.path.join(self._sheet_dir(spreadsheet_url), _digest(cell_range) + ".json")
+
+	def _load(self, path):
+		with open(path) as f:
+			return json.load(f)
+
+	def _save(self, path, snapshot):
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		# each writer uses its own temporary file, so that concurrent reads of the same range never swap in
+		# each other's half-written snapshot
+		with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), suffix=".tmp", delete=False) as f:
+			json.dump(snapshot, f)
+		os.replace(f.name, path)
+
+	"""
+	function: _covering_snapshot
+
+	Returns the rows for cell_range from a snapshot of the same spreadsheet, either of exactly that range
+	or of an open-ended range with the same columns that starts at or above it. Returns (snapshot, rows),
+	or (None, None) if there is no such snapshot.
+	"""
+	def _covering_snapshot(self, spreadsheet_url, cell_range, revision=None):
+		exact_path = self._snapshot_path(spreadsheet_url, cell_range)
+		if(os.path.isfile(exact_path)):
+			snapshot = self._load(exact_path)
+			if(revision is None or snapshot["revision"] == revision):
+				return snapshot, snapshot["values"]
+
+		wanted = OPEN_ENDED_RANGE.match(cell_range)
+		sheet_dir = self._sheet_dir(spreadsheet_url)
+		if(wanted is None or not os.path.isdir(sheet_dir)):
+			return None, None
+		for name in os.listdir(sheet_dir):
+			if(not name.endswith(".json")):
+				continue
+			snapshot = self._load(os.path.join(sheet_dir, name))
+			cached = OPEN_ENDED_RANGE.match(snapshot["range"])
+			if(cached is None or (cached.group(1), cached.group(3)) != (wanted.group(1), wanted.group(3))):
+				continue
+			if(int(cached.group(2)) > int(wanted.group(2))):
+				continue
+			if(revision is not None and snapshot["revision"] != revision):
+				continue
+			return snapshot, snapshot["values"][int(wanted.group(2)) - int(cached.group(2)):]
+		return None, None
+
+	"""
+	function: read
+
+	Reads cell_range from the first worksheet of a spreadsheet, going through the snapshot cache.
+	get_client is only called if the API actually has to be used. If the caller has just fetched the
+	spreadsheet's revision (e.g. to check which sheets changed), passing it in skips both the TTL and the
+	metadata call: a snapshot of that revision is used if there is one, and the range is read otherwise.
+	"""
+	def read(self, get_client, spreadsheet_url, cell_range, revision=None):
+		if(self.offline):
+			snapshot, values = self._covering_snapshot(spreadsheet_url, cell_range)
+			if(snapshot is None):
+				raise ValueError('No cached snapshot of ' + cell_range + ' for ' + spreadsheet_url + '. Run once without --offline first.')
+			return values
+
+		path = self._snapshot_path(spreadsheet_url, cell_range)
+		now = time.time()
+		if(revision is None and os.path.isfile(path)):
+			snapshot = self._load(path)
+			if(now - snapshot["fetched_at"] < self.ttl):
+				return snapshot["values"]
+
+		if(revision is None):
+			revision = spreadsheet_revision(get_client(), spreadsheet_url)
+		if(revision is not None):
+			snapshot, values = self._covering_snapshot(spreadsheet_url, cell_range, revision)
+			if(snapshot is not None):
+				if(snapshot["range"] == cell_range):
+					snapshot["fetched_at"] = now
+					self._save(path, snapshot)
+				return values
+
+		sh = get_client().open_by_url(spreadsheet_url).sheet1
+		values = sh.get_values(cell_range)
+		self._save(path, {"url": spreadsheet_url, "range": cell_range, "revision": revision, "fetched_at": now, "values": values})
+		return values
+
+	"""
+	function: invalidate
+
+	Drops every snapshot of a spreadsheet (e.g. after writing to it).
+	"""
+	def invalidate(self, spreadsheet_url):
+		shutil.rmtree(self._sheet_dir(spreadsheet_url), ignore_errors=True)
+
+	"""
+	function: evict
+
+	Deletes snapshots that have not been read or revalidated for evict_after seconds.
+	"""
+	def evict(self):
+		if(not os.path.isdir(self.cache_dir)):
+			return
+		cutoff = time.time() - self.evict_after
+		for sheet_dir in os.listdir(self.cache_dir):
+			sheet_dir = os.path.join(self.cache_dir, sheet_dir)
+			for name in os.listdir(sheet_dir):
+				path = os.path.join(sheet_dir, name)
+				# another process may be replacing (or evicting) the same files
+				try:
+					if(os.path.getmtime(path) < cutoff):
+						os.remove(path)
+				except FileNotFoundError:
+					pass
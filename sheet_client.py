@@ -0,0 +1,260 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from sheet_cache import SheetCache, spreadsheet_revision
+from tracing import TRACER, payload_bytes
+
+"""
+Shared access to the raters' Google Sheets.
+
+The Sheets API allows a limited number of read and write requests per minute, so every gspread call made
+by the scripts goes through a ThrottledClient:
+- reads and writes draw from separate token buckets (READS_PER_MINUTE / WRITES_PER_MINUTE, which can be
+  overridden with the SHEETS_READS_PER_MINUTE / SHEETS_WRITES_PER_MINUTE environment variables)
+- calls that fail with a quota (429) or server (5xx) error are retried with exponential backoff and jitter,
+  and the bucket that hit the quota slows down, then speeds back up as calls succeed again
+- identical reads that are in flight at the same time (e.g. from several threads) are coalesced into one call
+
+Every call is recorded by tracing.TRACER (when tracing is enabled), with its latency, retries, and the time
+spent waiting on the rate limiter and backing off.
+
+Reads for several raters are fanned out across a bounded thread pool, and are served from on-disk snapshots
+(see sheet_cache.py) when the sheet has not changed since it was last read.
+
+The gspread client is only created (and the service account only read) the first time it is needed, so
+that offline runs never authenticate. A different client (e.g. a local fake) can be swapped in with
+set_client().
+"""
+SERVICE_ACCOUNT_FILE = './tpm-data-annotation-aae74b403ab4.json'
+READS_PER_MINUTE = int(os.environ.get("SHEETS_READS_PER_MINUTE", 60))
+WRITES_PER_MINUTE = int(os.environ.get("SHEETS_WRITES_PER_MINUTE", 60))
+MAX_WORKERS = 8
+
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 64.0
+
+# gspread methods and properties, by the quota they count against
+READ_METHODS = {"open_by_url", "open_by_key", "get_file_drive_metadata", "fetch_sheet_metadata", "get_lastUpdateTime", "worksheet", "get_worksheet",
+	"get", "get_values", "get_all_values", "batch_get", "col_values", "row_values", "acell", "cell", "range", "find", "findall"}
+WRITE_METHODS = {"update", "update_cells", "batch_update", "values_update", "values_batch_update", "append_row", "append_rows", "add_rows", "resize"}
+READ_PROPERTIES = {"sheet1"}
+
+"""
+class: RateLimiter
+
+A thread-safe token bucket: up to `per_minute` calls per minute, with bursts of up to `burst` calls.
+The rate is halved by penalize() (when the API reports that we are over quota) and recovers gradually
+with each reward() (a successful call).
+"""
+class RateLimiter:
+	def __init__(self, per_minute, burst=None):
+		self.max_rate = per_minute / 60.0
+		self.rate = self.max_rate
+		self.capacity = burst if burst is not None else per_minute
+		self.tokens = float(self.capacity)
+		self.updated = time.monotonic()
+		self.lock = threading.Lock()
+
+	# returns the number of seconds spent waiting for a token
+	def acquire(self):
+		waited = 0.0
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+				if(self.tokens >= 1):
+					self.tokens -= 1
+					return waited
+				wait = (1 - self.tokens) / self.rate
+			time.sleep(wait)
+			waited += wait
+
+	def penalize(self):
+		with self.lock:
+			self.rate = max(self.max_rate / 16, self.rate / 2)
+			self.tokens = min(self.tokens, 0)
+
+	def reward(self):
+		with self.lock:
+			self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+READ_LIMITER = RateLimiter(READS_PER_MINUTE)
+WRITE_LIMITER = RateLimiter(WRITES_PER_MINUTE)
+
+"""
+function: configure_quota
+
+Changes the per-minute read and/or write budgets.
+"""
+def configure_quota(reads_per_minute=None, writes_per_minute=None):
+	global READ_LIMITER, WRITE_LIMITER
+	if(reads_per_minute is not None):
+		READ_LIMITER = RateLimiter(reads_per_minute)
+	if(writes_per_minute is not None):
+		WRITE_LIMITER = RateLimiter(writes_per_minute)
+
+def _error_status(error):
+	status = getattr(error, "code", None)
+	if(status is None):
+		status = getattr(getattr(error, "response", None), "status_code", None)
+	return status
+
+def _retry_after(error):
+	headers = getattr(getattr(error, "response", None), "headers", None) or {}
+	try:
+		return float(headers.get("Retry-After"))
+	except (TypeError, ValueError):
+		return None
+
+"""
+function: call_with_backoff
+
+Calls fn() once a token is available from the limiter. Quota (429) and server (5xx) errors are retried
+with exponential backoff and full jitter (or after the Retry-After the API asks for); other errors are raised.
+"""
+def call_with_backoff(fn, limiter, name="call", request=None):
+	throttle_wait = backoff = 0.0
+	start = time.perf_counter()
+	for attempt in range(MAX_RETRIES + 1):
+		throttle_wait += limiter.acquire()
+		try:
+			result = fn()
+		except Exception as error:
+			status = _error_status(error)
+			if(not isinstance(status, int) or not (status == 429 or status >= 500) or attempt == MAX_RETRIES):
+				TRACER.record("api", name, time.perf_counter() - start, retries=attempt, throttle_wait_s=throttle_wait, backoff_s=backoff, error=repr(error))
+				raise
+			if(status == 429):
+				limiter.penalize()
+			wait = _retry_after(error)
+			if(wait is None):
+				wait = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+			time.sleep(wait)
+			backoff += wait
+		else:
+			limiter.reward()
+			if(TRACER.enabled):
+				TRACER.record("api", name, time.perf_counter() - start, retries=attempt, throttle_wait_s=throttle_wait, backoff_s=backoff, bytes=payload_bytes(request) + payload_bytes(result))
+			return result
+
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+"""
+function: coalesce
+
+Runs fn() for the given key, unless a call with the same key is already running; in that case, waits for
+it and returns its result instead of calling the API again.
+"""
+def coalesce(key, fn):
+	with _in_flight_lock:
+		future = _in_flight.get(key)
+		owner = future is None
+		if(owner):
+			future = _in_flight[key] = Future()
+	if(not owner):
+		return future.result()
+	try:
+		future.set_result(fn())
+	except Exception as error:
+		future.set_exception(error)
+	finally:
+		with _in_flight_lock:
+			del _in_flight[key]
+	return future.result()
+
+def _is_sheet_object(value):
+	# check the class, so that properties which call the API (like sheet1) are not evaluated
+	return hasattr(type(value), "sheet1") or hasattr(type(value), "update_cells")
+
+"""
+class: ThrottledClient
+
+Wraps a gspread client (and the spreadsheets and worksheets it returns) so that every API call is
+rate-limited, retried on quota/server errors, and (for reads) coalesced. Everything else is passed through.
+"""
+class ThrottledClient:
+	def __init__(self, target, scope=""):
+		self._target = target
+		self._scope = scope
+
+	def _wrap(self, value):
+		if(_is_sheet_object(value) and not isinstance(value, ThrottledClient)):
+			return ThrottledClient(value, self._scope + "/" + str(getattr(value, "id", id(value))))
+		return value
+
+	def __getattr__(self, name):
+		if(name in READ_PROPERTIES):
+			return self._wrap(coalesce((self._scope, name), lambda: call_with_backoff(lambda: getattr(self._target, name), READ_LIMITER, name)))
+		value = getattr(self._target, name)
+		if(name == "spreadsheet"):
+			return self._wrap(value)
+		if(not callable(value) or (name not in READ_METHODS and name not in WRITE_METHODS)):
+			return value
+
+		def throttled(*args, **kwargs):
+			if(name in WRITE_METHODS):
+				return self._wrap(call_with_backoff(lambda: value(*args, **kwargs), WRITE_LIMITER, name, request=list(args)))
+			key = (self._scope, name, repr(args), repr(sorted(kwargs.items())))
+			return self._wrap(coalesce(key, lambda: call_with_backoff(lambda: value(*args, **kwargs), READ_LIMITER, name)))
+		return throttled
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+	global _client
+	with _client_lock:
+		if(_client is None):
+			import gspread
+			# Authenticating with Google Sheeets
+			# Service Email: tpm-data-annotation@tpm-data-annotation.iam.gserviceaccount.com
+			_client = ThrottledClient(gspread.service_account(filename=SERVICE_ACCOUNT_FILE))
+		return _client
+
+def set_client(client, throttled=True):
+	global _client
+	_client = ThrottledClient(client) if throttled else client
+
+SHEET_CACHE = SheetCache()
+
+"""
+function: read_sheet_range
+
+Reads a single range from the first worksheet of a spreadsheet (through the snapshot cache). revision is the
+spreadsheet's current revision, if the caller already knows it (see SheetCache.read).
+"""
+def read_sheet_range(spreadsheet_url, cell_range, revision=None):
+	return SHEET_CACHE.read(get_client, spreadsheet_url, cell_range, revision)
+
+"""
+function: read_sheet_ranges
+
+Reads the same range from each spreadsheet concurrently, opening each spreadsheet at most once.
+Returns the values in the same order as spreadsheet_urls. revisions (optional) holds the current revision of
+each spreadsheet, in the same order.
+"""
+def read_sheet_ranges(spreadsheet_urls, cell_range, max_workers=MAX_WORKERS, revisions=None):
+	spreadsheet_urls = list(spreadsheet_urls)
+	if(not spreadsheet_urls):
+		return []
+	revisions = list(revisions) if revisions is not None else [None] * len(spreadsheet_urls)
+	with ThreadPoolExecutor(max_workers=min(max_workers, len(spreadsheet_urls))) as pool:
+		return list(pool.map(lambda url, revision: read_sheet_range(url, cell_range, revision), spreadsheet_urls, revisions))
+
+"""
+function: read_revisions
+
+Fetches the current revision (Drive modifiedTime) of each spreadsheet concurrently: one metadata call per
+spreadsheet, which is far cheaper than reading its values. Returns the revisions in the same order.
+"""
+def read_revisions(spreadsheet_urls, max_workers=MAX_WORKERS):
+	spreadsheet_urls = list(spreadsheet_urls)
+	if(not spreadsheet_urls):
+		return []
+	with ThreadPoolExecutor(max_workers=min(max_workers, len(spreadsheet_urls))) as pool:
+		return list(pool.map(lambda url: spreadsheet_revision(get_client(), url), spreadsheet_urls))
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+
+# Stratified matching of two datasets (e.g. winning vs. awry conversations) on one or more features.
+#
+# Every row is assigned to a stratum: the combination of its values for each feature, where continuous
+# features are first cut into quantile bins (shared by both datasets). Each stratum is then cut down to the
+# same number of rows in both datasets (the smaller of the two counts), choosing rows at random with a fixed
+# seed. All of this is done with a handful of array operations, whatever the number of strata, and the
+# result is returned as positional index arrays into the inputs (rather than copies of the data).
+
+# Default number of quantile bins for continuous (float) features
+DEFAULT_BINS = 10
+DEFAULT_SEED = 19104
+
+# Function to decide how each feature is stratified: None for exact values, or a number of quantile bins
+def feature_bins(data, features, bins=None):
+    bins = bins or {}
+    return {
+        feature: bins.get(feature, DEFAULT_BINS if pd.api.types.is_float_dtype(data[feature]) else None)
+        for feature in features
+    }
+
+# Function to code one feature of both datasets on the same scale (-1 for missing values)
+def feature_codes(first_values, second_values, n_bins=None):
+    values = np.concatenate([np.asarray(first_values), np.asarray(second_values)])
+    if n_bins is None:
+        codes, _ = pd.factorize(values)
+    else:
+        values = values.astype(float)
+        missing = np.isnan(values)
+        # quantile edges over both datasets; repeated edges (from heavily repeated values) are merged
+        edges = np.unique(np.quantile(values[~missing], np.linspace(0, 1, n_bins + 1)[1:-1])) if (~missing).any() else np.array([])
+        codes = np.searchsorted(edges, values, side="right")
+        codes[missing] = -1
+    return codes[:len(first_values)], codes[len(first_values):]
+
+# Function to assign every row of both datasets to a stratum (-1 for rows with a missing feature)
+def strata_codes(first_data, second_data, features, bins=None):
+    n_bins = feature_bins(first_data, features, bins)
+    first_codes = np.zeros(len(first_data), dtype=np.int64)
+    second_codes = np.zeros(len(second_data), dtype=np.int64)
+    first_missing = np.zeros(len(first_data), dtype=bool)
+    second_missing = np.zeros(len(second_data), dtype=bool)
+    for feature in features:
+        first_feature, second_feature = feature_codes(first_data[feature], second_data[feature], n_bins[feature])
+        first_missing |= first_feature < 0
+        second_missing |= second_feature < 0
+        # mix the feature into the combined code, then renumber so the codes stay small
+        n_levels = max(first_feature.max(initial=0), second_feature.max(initial=0)) + 1
+        combined, _ = pd.factorize(np.concatenate([first_codes * n_levels + first_feature, second_codes * n_levels + second_feature]))
+        first_codes, second_codes = combined[:len(first_data)], combined[len(first_data):]
+    first_codes[first_missing] = -1
+    second_codes[second_missing] = -1
+    return first_codes, second_codes
+
+# Function to pick the first `keep[code]` rows of each stratum, in a random order
+def sample_strata(codes, keep, rng):
+    # shuffle, then (stably) sort by stratum: each stratum's rows end up together, in a random order
+    order = rng.permutation(len(codes))
+    order = order[np.argsort(codes[order], kind="stable")]
+    sorted_codes = codes[order]
+    valid = sorted_codes >= 0
+    order, sorted_codes = order[valid], sorted_codes[valid]
+    # the rank of each row within its stratum (like groupby().cumcount())
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]) if len(sorted_codes) else np.array([], dtype=np.int64)
+    ranks = np.arange(len(sorted_codes)) - np.repeat(starts, np.diff(np.r_[starts, len(sorted_codes)]))
+    return np.sort(order[ranks < keep[sorted_codes]])
+
+# Function to match two datasets on the given features; returns the positional indices of the rows to keep
+def stratified_indices(first_data, second_data, features, bins=None, seed=DEFAULT_SEED):
+    first_codes, second_codes = strata_codes(first_data, second_data, features, bins)
+    n_strata = max(first_codes.max(initial=-1), second_codes.max(initial=-1)) + 1
+    # keep the smaller of the two counts in every stratum
+    keep = np.minimum(
+        np.bincount(first_codes[first_codes >= 0], minlength=n_strata),
+        np.bincount(second_codes[second_codes >= 0], minlength=n_strata)
+    )
+    rng = np.random.default_rng(seed)
+    return sample_strata(first_codes, keep, rng), sample_strata(second_codes, keep, rng)
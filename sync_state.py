@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+try:
+	import fcntl
+except ImportError: # not available on Windows
+	fcntl = None
+
+"""
+Per-rater sync state for the conflict rating scheduler.
+
+For each rater we store:
+- watermark: the last sheet row such that every row up to (and including) it is fully rated
+- block_hashes: a content hash of each block of BLOCK_SIZE sheet rows past the watermark, as of the last sync
+- validated_through: the last sheet row that the rating drop-downs (data validation) have been applied to
+- filled_row, grid_rows: the last sheet row that messages were written to, and the sheet's row count at the
+  time; the next allocation goes below filled_row without scanning the sheet, as long as the row count
+  still matches and filled_row is still the last filled row (see next_available_row)
+- revision: the sheet's revision (Drive modifiedTime) as of the last sync, if known; the watcher (see
+  watch.py) skips raters whose sheet has not been modified since
+
+Rows at or below the watermark are never re-read, and blocks whose hash has not changed are not re-diffed
+against the log.
+"""
+SYNC_STATE_PATH = './CONFLICT_CONVO_SYNC_STATE.json'
+
+# The first two rows of every rating sheet are headers
+FIRST_DATA_ROW = 3
+BLOCK_SIZE = 50
+
+def load_sync_state(path=SYNC_STATE_PATH):
+	if(not os.path.isfile(path)):
+		return {}
+	with open(path) as f:
+		return json.load(f)
+
+"""
+function: save_sync_state
+
+Saves the sync state. If rater_id is given, only that rater's entry is written back (merged into the
+state currently on disk), so that scheduler runs for different raters can run in parallel.
+"""
+def save_sync_state(state, path=SYNC_STATE_PATH, rater_id=None):
+	with open(path + ".lock", "w") as lock:
+		if(fcntl is not None):
+			fcntl.flock(lock, fcntl.LOCK_EX)
+		if(rater_id is not None):
+			rater_state = state[rater_id]
+			state = load_sync_state(path)
+			state[rater_id] = rater_state
+		# write to a temporary file first, so an interrupted run never leaves a truncated state file
+		tmp_path = path + ".tmp"
+		with open(tmp_path, "w") as f:
+			json.dump(state, f, indent=1, sort_keys=True)
+		os.replace(tmp_path, path)
+
+def get_rater_state(state, rater_id):
+	rater_state = state.setdefault(rater_id, {})
+	rater_state.setdefault("watermark", FIRST_DATA_ROW - 1)
+	rater_state.setdefault("block_hashes", {})
+	rater_state.setdefault("validated_through", FIRST_DATA_ROW - 1)
+	return rater_state
+
+"""
+function: next_available_row
+
+Returns (sheet_id, grid_rows, available_row) for the first worksheet of a spreadsheet: its sheetId, its row
+count, and its first empty row, going by column colnum. If rater_state holds a cursor (filled_row), a single
+metadata call fetches the worksheet's properties together with the two cells at and below the cursor; the row
+below the cursor is returned if the row count has not changed since the cursor was recorded, the first cell is
+filled and the second empty. Otherwise (e.g. something was written to the sheet from elsewhere) the whole
+column is scanned.
+"""
+def next_available_row(spreadsheet, rater_state=None, colnum=1):
+	if(rater_state is not None and rater_state.get("filled_row") is not None):
+		filled_row = rater_state["filled_row"]
+		column = chr(ord("A") + colnum - 1)
+		# a range without a sheet name is on the first worksheet, which is the only one returned
+		sheet = spreadsheet.fetch_sheet_metadata({
+			"ranges": "{0}{1}:{0}{2}".format(column, filled_row, filled_row + 1),
+			"includeGridData": "true",
+			"fields": "sheets(properties(sheetId,gridProperties(rowCount)),data(rowData(values(formattedValue))))"
+		})["sheets"][0]
+		sheet_id, grid_rows = sheet["properties"]["sheetId"], sheet["properties"]["gridProperties"]["rowCount"]
+		# empty cells (and empty rows at the end of the range) are left out of the response
+		cells = [(row.get("values") or [{}])[0].get("formattedValue", "") for row in sheet.get("data", [{}])[0].get("rowData", [])] + ["", ""]
+		if(rater_state.get("grid_rows") == grid_rows and cells[0] != "" and cells[1] == ""):
+			return sheet_id, grid_rows, filled_row + 1
+	worksheet = spreadsheet.sheet1
+	# Modified from: https://stackoverflow.com/questions/40781295/how-to-find-the-first-empty-row-of-a-google-spread-sheet-using-python-gspread
+	str_list = list(filter(None, worksheet.col_values(colnum)))
+	return worksheet.id, worksheet.row_count, len(str_list)+2
+
+"""
+function: set_filled_row
+
+Records the last row that messages have been written to, and the sheet's row count after writing them.
+"""
+def set_filled_row(rater_state, filled_row, grid_rows):
+	rater_state["filled_row"] = filled_row
+	rater_state["grid_rows"] = grid_rows
+
+"""
+function: block_start_for_row
+
+Returns the first sheet row of the block containing `row`, so that blocks line up across syncs.
+"""
+def block_start_for_row(row):
+	row = max(row, FIRST_DATA_ROW)
+	return FIRST_DATA_ROW + ((row - FIRST_DATA_ROW) // BLOCK_SIZE) * BLOCK_SIZE
+
+"""
+function: hash_block
+
+Returns a content hash for a list of sheet rows (each a list of cell values).
+"""
+def hash_block(rows):
+	return hashlib.md5(json.dumps(rows, ensure_ascii=False).encode("utf-8")).hexdigest()
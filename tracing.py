@@ -0,0 +1,109 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+import pandas as pd
+
+"""
+Tracing of where a run spends its time.
+
+Two kinds of events are recorded by the global TRACER:
+- "api": every Sheets API call made through sheet_client, with its latency, the number of retries, the time
+  spent waiting for the rate limiter (throttle_wait_s) and backing off after errors (backoff_s), and the
+  approximate size of the request and response (bytes)
+- "stage": the local stages of each script (e.g. reading the log, merging ratings into it, writing it)
+
+Tracing is off until enable() is called (the scripts do this for --trace). At the end of a run, summary()
+aggregates the events into one row per (kind, name); if a trace path was given, every event is also written
+to it as a line of JSON as it happens.
+"""
+SUMMARY_COLUMNS = ["kind", "name", "count", "total_s", "mean_ms", "max_ms", "retries", "throttle_wait_s", "backoff_s", "bytes", "errors"]
+
+def payload_bytes(value):
+	# only plain data (values, request bodies) is sized; gspread objects count as 0
+	if(isinstance(value, (list, dict, str))):
+		return len(json.dumps(value, default=str))
+	return 0
+
+class Tracer:
+	def __init__(self):
+		self.enabled = False
+		self.events = []
+		self.trace_file = None
+		self.lock = threading.Lock()
+
+	"""
+	function: enable
+
+	Starts recording events, and (if trace_path is given) writing each one to trace_path as JSON lines.
+	"""
+	def enable(self, trace_path=None):
+		self.enabled = True
+		if(trace_path):
+			self.trace_file = open(trace_path, "w", buffering=1)
+
+	def record(self, kind, name, duration, **fields):
+		if(not self.enabled):
+			return
+		event = {"time": time.time(), "kind": kind, "name": name, "duration_s": duration, "thread": threading.current_thread().name}
+		event.update(fields)
+		with self.lock:
+			self.events.append(event)
+			if(self.trace_file is not None):
+				self.trace_file.write(json.dumps(event, default=str) + "\n")
+
+	"""
+	function: stage
+
+	Context manager that records how long a local stage of a script takes.
+	"""
+	@contextmanager
+	def stage(self, name):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.record("stage", name, time.perf_counter() - start)
+
+	"""
+	function: summary
+
+	Aggregates the recorded events into one row per (kind, name), slowest first.
+	"""
+	def summary(self):
+		with self.lock:
+			events = pd.DataFrame(self.events)
+		if(events.empty):
+			return pd.DataFrame(columns=SUMMARY_COLUMNS)
+		for col in ["retries", "throttle_wait_s", "backoff_s", "bytes"]:
+			events[col] = events[col].fillna(0) if col in events else 0
+		events["errors"] = events["error"].notna() if "error" in events else False
+		summary = events.groupby(["kind", "name"]).agg(
+			count=("duration_s", "size"),
+			total_s=("duration_s", "sum"),
+			mean_ms=("duration_s", lambda d: d.mean() * 1000),
+			max_ms=("duration_s", lambda d: d.max() * 1000),
+			retries=("retries", "sum"),
+			throttle_wait_s=("throttle_wait_s", "sum"),
+			backoff_s=("backoff_s", "sum"),
+			bytes=("bytes", "sum"),
+			errors=("errors", "sum")
+		).reset_index()
+		return summary.sort_values("total_s", ascending=False)[SUMMARY_COLUMNS].round(4).reset_index(drop=True)
+
+	def close(self):
+		if(self.trace_file is not None):
+			self.trace_file.close()
+			self.trace_file = None
+
+TRACER = Tracer()
+
+"""
+function: report
+
+Prints the run summary (if tracing is enabled) and closes the trace file.
+"""
+def report():
+	if(TRACER.enabled):
+		print(TRACER.summary().to_string(index=False))
+	TRACER.close()
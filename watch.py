@@ -0,0 +1,177 @@
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+import sheet_client
+import conflict_rating_scheduler as scheduler
+import irr_conflict
+from disagreement_history import DisagreementHistory
+from agreement_engine import encode_ratings, category_counts, compute_agreement
+from labeling_log import open_label_log
+from rating_dictionary import RATING_DICTIONARY
+from sheet_client import read_revisions
+from sync_state import load_sync_state
+from tracing import TRACER, report
+
+"""
+Keeps the labeling log, the IRR numbers, and the disagreement files current for every rater, in one
+long-running process.
+
+Every `interval` seconds, the watcher fetches the revision (Drive modifiedTime) of each rater's sheet: one
+cheap metadata call per rater. Nothing else is read unless a sheet has changed since the last round:
+- a changed sheet is read once (columns A-H), and synced into the log with the scheduler's update(); the
+  revision that was synced is kept in the sync state, so that a restarted watcher does not re-sync sheets
+  that haven't changed
+- the rows of every sheet are kept in memory between rounds, so the IRR is recomputed by re-encoding only the
+  changed raters' answers
+- the disagreement file of a metric is only rewritten if that metric's answers (or the rated rows) changed;
+  with --record-rounds, the rewritten files are also recorded as a round of the disagreement history (see
+  disagreement_history.py)
+"""
+DEFAULT_INTERVAL = 300
+DISAGREEMENT_DIR = './disagreed_messages/'
+
+class SheetWatcher:
+	def __init__(self, rater_ids, metrics=irr_conflict.METRICS, history=None):
+		self.rater_ids = list(rater_ids)
+		self.metrics = metrics
+		self.history = history
+		self.revisions = {}
+		self.blocks = {}
+		self.encoded = {}
+		self.last_answers = None
+		self.last_messages = None
+
+	"""
+	function: changed_raters
+
+	Fetches every sheet's revision, and returns the raters whose sheet changed since the last round
+	(every rater, on the first round), with their new revisions.
+	"""
+	def changed_raters(self):
+		with TRACER.stage("revision check"):
+			revisions = dict(zip(self.rater_ids, read_revisions(RATING_DICTIONARY[rater_id] for rater_id in self.rater_ids)))
+		return {rater_id: revision for rater_id, revision in revisions.items() if revision is None or revision != self.revisions.get(rater_id)}
+
+	"""
+	function: sync
+
+	Reads the changed sheets (served from the sheet cache if a snapshot of the same revision exists) and
+	updates the log for each rater whose sheet was modified since it was last synced.
+	"""
+	def sync(self, changed):
+		rater_ids = list(changed)
+		with TRACER.stage("read sheets"):
+			blocks = irr_conflict.get_rating_blocks([RATING_DICTIONARY[rater_id] for rater_id in rater_ids], revisions=[changed[rater_id] for rater_id in rater_ids])
+		synced = load_sync_state()
+		for rater_id, block in zip(rater_ids, blocks):
+			self.blocks[rater_id] = block
+			# the answers are encoded per rater, so only the changed raters are re-encoded
+			answers = np.array(block, dtype=object).reshape(len(block), len(irr_conflict.SHEET_COLUMNS))[:, [irr_conflict.SHEET_COLUMNS.index(metric["column"]) for metric in self.metrics.values()]]
+			self.encoded[rater_id] = encode_ratings(answers[np.newaxis], [metric["conversion"] for metric in self.metrics.values()])[0]
+			if(changed[rater_id] is None or synced.get(rater_id, {}).get("revision") != changed[rater_id]):
+				scheduler.update(rater_id, revision=changed[rater_id])
+			self.revisions[rater_id] = changed[rater_id]
+
+	"""
+	function: refresh_irr
+
+	Recomputes the IRR from the sheets kept in memory, and rewrites the disagreement files of the metrics
+	whose answers changed. Returns the agreement summary and the names of the metrics that changed.
+	"""
+	def refresh_irr(self):
+		blocks = [self.blocks[rater_id] for rater_id in self.rater_ids]
+		rows = irr_conflict.shared_rated_rows(blocks)
+		if(rows.shape[1] == 0):
+			return None, []
+
+		with TRACER.stage("agreement"):
+			answers = irr_conflict.get_answers(blocks, rows, self.metrics)
+			ratings = np.stack([self.encoded[rater_id][rater_rows] for rater_id, rater_rows in zip(self.rater_ids, rows)])
+			summary, pairwise = compute_agreement(ratings, irr_conflict.N_CATEGORIES, list(self.metrics), self.rater_ids)
+
+		# the files also hold each message's id and text (from the first sheet), so if those (or the rated rows) changed, every file does
+		messages = [[blocks[0][row][irr_conflict.SHEET_COLUMNS.index(col)] for col in ["B", "D"]] for row in rows[0]]
+		if(self.last_answers is None or self.last_answers.shape != answers.shape or messages != self.last_messages):
+			changed_metrics = list(self.metrics)
+		else:
+			changed_metrics = [metric for metric_index, metric in enumerate(self.metrics) if (answers[:, :, metric_index] != self.last_answers[:, :, metric_index]).any()]
+
+		with TRACER.stage("disagreement files"):
+			os.makedirs(DISAGREEMENT_DIR, exist_ok=True)
+			counts = category_counts(ratings, irr_conflict.N_CATEGORIES)
+			disagreements = {}
+			for metric in changed_metrics:
+				metric_index = list(self.metrics).index(metric)
+				disagreements[metric] = irr_conflict.get_disagreed_messages(counts[:, metric_index, :], answers[:, :, metric_index].tolist(), blocks, rows, metric, self.rater_ids)
+				disagreements[metric].to_csv(DISAGREEMENT_DIR + metric + '.csv')
+		if(self.history is not None and disagreements):
+			with TRACER.stage("disagreement history"):
+				self.history.record_round(str(pd.Timestamp.now()), disagreements)
+
+		self.last_answers = answers
+		self.last_messages = messages
+		return summary, changed_metrics
+
+	"""
+	function: poll
+
+	Runs one round: checks every sheet for changes, syncs the changed ones, and refreshes the IRR.
+	Returns the raters whose sheets changed.
+	"""
+	def poll(self):
+		changed = self.changed_raters()
+		if(not changed):
+			return []
+		self.sync(changed)
+		summary, changed_metrics = self.refresh_irr()
+		if(summary is None):
+			print("Not enough ratings!")
+		else:
+			print({metric["label"]: summary.loc[name, "observed_agreement"] for name, metric in self.metrics.items()})
+			print(summary.to_string())
+			print("Disagreement files rewritten for: " + (", ".join(changed_metrics) if changed_metrics else "(none)"))
+		return list(changed)
+
+"""
+function: watch
+
+Polls every rater's sheet every `interval` seconds (for `rounds` rounds, or until interrupted).
+An error in one round (e.g. an API call that still fails after its retries) is reported, and the sheets are
+checked again in the next round.
+"""
+def watch(interval=DEFAULT_INTERVAL, rounds=None, rater_ids=None, record_rounds=False):
+	watcher = SheetWatcher(rater_ids or list(irr_conflict.irr_raters()), history=DisagreementHistory() if record_rounds else None)
+	round_number = 0
+	while(rounds is None or round_number < rounds):
+		started = time.monotonic()
+		try:
+			changed = watcher.poll()
+			print(str(pd.Timestamp.now()) + ": " + (str(len(changed)) + " sheet(s) changed (" + ", ".join(changed) + ")" if changed else "no sheets changed"))
+		except Exception as error:
+			print(str(pd.Timestamp.now()) + ": round failed, retrying next round: " + repr(error))
+		round_number += 1
+		if(rounds is None or round_number < rounds):
+			time.sleep(max(0, interval - (time.monotonic() - started)))
+	return watcher
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description='Keeps the labeling log, the IRR numbers, and the disagreement files current, syncing only the rater sheets that changed.')
+	parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL, help='Seconds between checks of the sheets (default: %(default)s).')
+	parser.add_argument('--rounds', type=int, default=None, help='Stop after this many rounds (default: run until interrupted).')
+	parser.add_argument('--record-rounds', action='store_true', help='Record every change to the disagreement files as a round of the disagreement history (see disagreement_history.py).')
+	parser.add_argument('--log-backend', choices=['csv', 'sqlite'], default=os.environ.get("CONFLICT_LOG_BACKEND", "csv"), help='Which labeling log backend to use (default: csv).')
+	parser.add_argument('--trace', nargs='?', const='', help='Print a summary of where the run spent its time when it stops. If a path is given, every call and stage is also written to it as JSON lines.')
+	args = parser.parse_args()
+	if args.trace is not None:
+		TRACER.enable(args.trace)
+	scheduler.LABEL_LOG = open_label_log(args.log_backend)
+	sheet_client.SHEET_CACHE.evict()
+
+	try:
+		watch(args.interval, args.rounds, record_rounds=args.record_rounds)
+	except KeyboardInterrupt:
+		print("Stopped watching.")
+	report()